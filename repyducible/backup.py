@@ -0,0 +1,135 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import zlib
+import hashlib
+import logging
+from datetime import datetime
+from argparse import ArgumentParser
+
+from repyducible.util import output_dir_create, data_from_file, data_to_file
+
+class SourceStore(object):
+    """ Content-addressed store of (compressed) source files
+
+    Files are identified by the SHA-1 of their content. A backup only
+    consists of a manifest mapping paths to hashes; only files not yet
+    contained in the store are compressed and added. File hashes are cached
+    by path, modification time and size, so unchanged files are not even
+    read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stat_file = os.path.join(path, "stat.pickle")
+
+    def blob(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def _file_digest(self, file_path, stat_cache):
+        st = os.stat(file_path)
+        key = os.path.abspath(file_path)
+        cached = stat_cache.get(key, None)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size) \
+           and os.path.exists(self.blob(cached[2])):
+            return cached[2]
+
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()
+        blob = self.blob(digest)
+        if not os.path.exists(blob):
+            output_dir_create(os.path.dirname(blob))
+            tmp_blob = "%s.tmp-%d" % (blob, os.getpid())
+            with open(tmp_blob, 'wb') as f:
+                f.write(zlib.compress(content))
+            os.replace(tmp_blob, blob)
+        stat_cache[key] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def manifest(self, files):
+        """ Add files to the store.
+
+        Args:
+            files : list of pairs (path to file, path inside of the backup)
+                    as returned by `repyducible.util.source_files`
+        Returns:
+            manifest dict with keys 'files' (path inside of the backup mapped
+            to hash), 'hash' (hash of the whole tree) and 'store'
+        """
+        stat_cache = data_from_file(self.stat_file, format="pickle")
+        stat_cache = {} if stat_cache is None else stat_cache
+        stat_cache_before = dict(stat_cache)
+        manifest = { 'files': {}, 'store': os.path.abspath(self.path) }
+        h = hashlib.sha1()
+        for file_path, backup_path in files:
+            digest = self._file_digest(file_path, stat_cache)
+            manifest['files'][backup_path] = digest
+            h.update(("%s %s\n" % (digest, backup_path)).encode("utf-8"))
+        manifest['hash'] = h.hexdigest()
+        if stat_cache != stat_cache_before:
+            output_dir_create(self.path)
+            data_to_file(stat_cache, self.stat_file, format="pickle")
+        return manifest
+
+    def backup(self, files, output_dir):
+        """ Add files to the store and write a manifest to `output_dir`.
+
+        Returns:
+            the manifest dict (see `manifest`)
+        """
+        manifest = self.manifest(files)
+        manifest_file = os.path.join(output_dir, "{}-source.manifest".format(
+            datetime.now().strftime('%Y%m%d%H%M%S')
+        ))
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        return manifest
+
+    def restore(self, manifest, dest):
+        """ Rebuild the source tree described by `manifest` in `dest`. """
+        for backup_path, digest in sorted(manifest['files'].items()):
+            file_path = os.path.join(dest, backup_path)
+            output_dir_create(os.path.dirname(file_path))
+            with open(self.blob(digest), 'rb') as f:
+                content = zlib.decompress(f.read())
+            with open(file_path, 'wb') as f:
+                f.write(content)
+
+def restore_source(args):
+    parser = ArgumentParser(prog='restore',
+                            description="Rebuild a source tree from a manifest.")
+    parser.add_argument('manifest', metavar='MANIFEST', type=str,
+                        help="Path to a *-source.manifest file.")
+    parser.add_argument('dest', metavar='DEST_DIR', type=str,
+                        help="Path to output directory.")
+    parser.add_argument('--store', metavar='STORE_DIR', default=None, type=str,
+                        help="Path to the source store "
+                             "(default: as recorded in the manifest).")
+    pargs = parser.parse_args(args)
+
+    with open(pargs.manifest, 'r') as f:
+        manifest = json.load(f)
+    store = SourceStore(manifest['store'] if pargs.store is None else pargs.store)
+    store.restore(manifest, pargs.dest)
+    logging.info("Restored %d files to %s." % (len(manifest['files']), pargs.dest))
+
+if __name__ == "__main__":
+    restore_source(sys.argv[1:])
@@ -0,0 +1,225 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import tempfile
+import time
+import logging
+import platform
+import importlib
+import multiprocessing
+from datetime import datetime
+from argparse import ArgumentParser
+
+import numpy as np
+
+from repyducible.util import DictAction
+from repyducible.data import storage_dir
+from repyducible.demo import discover_modules
+from repyducible.profiling import peak_rss
+
+def bench_combination(DataClass, ModelClass, solver, data_params={},
+                      solver_params={}, iterations=1000, warmup=1, repeats=3):
+    """ Time repeated solves of `ModelClass` applied to `DataClass`.
+
+    Args:
+        DataClass, ModelClass : as expected by `Experiment`
+        solver : solver engine (pdhg|cvx)
+        data_params, solver_params : dicts of parameters
+        iterations : fixed iteration budget (PDHG's `term_maxiter`)
+        warmup : number of untimed solves before the timed ones
+        repeats : number of timed solves
+    Returns:
+        dict with wall times, iterations per second, peak RSS and the final
+        objective
+    """
+    # out-of-core arrays of the data live in a temporary directory
+    with tempfile.TemporaryDirectory(prefix="repyducible-") as tmp_dir:
+        with storage_dir(tmp_dir):
+            data = DataClass(**data_params)
+        params = {
+            'data_name': DataClass.name, 'data': dict(data_params),
+            'model_name': ModelClass.name, 'model': {},
+            'solver_name': solver, 'solver': {}, 'plot': {}
+        }
+        data.apply_default_params(params)
+        params['solver'].update(solver_params)
+        if solver == "pdhg":
+            params['solver'].update(term_maxiter=iterations, term_relgap=0.0)
+
+        times = []
+        for r in range(warmup + repeats):
+            model = ModelClass(data, **params['model'])
+            model.setup_solver(solver)
+            t0 = time.perf_counter()
+            details = model.solve(dict(params['solver']))
+            if r >= warmup:
+                times.append(time.perf_counter() - t0)
+
+    iters = details.get('iter', iterations if solver == "pdhg" else None)
+    return {
+        'times': times,
+        'time': float(np.median(times)),
+        'time_min': float(np.min(times)),
+        'iters_per_sec': None if iters is None else iters/float(np.median(times)),
+        'peak_rss': peak_rss(),
+        'objective': details.get('objp', None),
+        'status': details.get('status', None),
+    }
+
+def _bench_task(task):
+    name, kwargs = task
+    try:
+        return dict(name, **bench_combination(**kwargs))
+    except Exception as e:
+        logging.exception("Benchmark %s failed." % (name,))
+        return dict(name, error=str(e))
+
+def run_benchmarks(data_classes, model_classes, solver="pdhg", **kwargs):
+    """ Benchmark all combinations of data and model classes.
+
+    Each combination runs in a fresh process so that peak memory usage is
+    measured separately.
+
+    Args:
+        data_classes, model_classes : dicts mapping names to classes
+        solver : solver engine (pdhg|cvx)
+        kwargs : passed to `bench_combination`
+    Returns:
+        list of result dicts
+    """
+    results = []
+    for dname, DataClass in sorted(data_classes.items()):
+        for mname, ModelClass in sorted(model_classes.items()):
+            name = { 'dataset': dname, 'model': mname, 'solver': solver }
+            logging.info("Benchmarking model '%s' on dataset '%s'..."
+                         % (mname, dname))
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            try:
+                result = pool.apply(_bench_task, ((name, dict(kwargs,
+                    DataClass=DataClass, ModelClass=ModelClass,
+                    solver=solver)),))
+            finally:
+                pool.close()
+                pool.join()
+            results.append(result)
+            if 'error' not in result:
+                ips = result['iters_per_sec']
+                logging.info("  %.3fs (min %.3fs), %s it/s, %.1f MB peak, "
+                             "objective %s" % (result['time'],
+                             result['time_min'],
+                             "-" if ips is None else "%.1f" % ips,
+                             result['peak_rss']/1e6, result['objective']))
+    return results
+
+def compare_reports(report, baseline, threshold=0.1):
+    """ Find benchmarks that got slower compared to a baseline report.
+
+    Args:
+        report, baseline : report dicts as written by `pkg_bench`
+        threshold : relative slowdown that is flagged (0.1 means 10%)
+    Returns:
+        list of dicts describing the slowdowns
+    """
+    key = lambda r: (r['dataset'], r['model'], r['solver'])
+    base = { key(r): r for r in baseline['results'] if 'error' not in r }
+    slowdowns = []
+    for r in report['results']:
+        if 'error' in r or key(r) not in base:
+            continue
+        ratio = r['time']/base[key(r)]['time']
+        if ratio > 1.0 + threshold:
+            slowdowns.append({ 'dataset': r['dataset'], 'model': r['model'],
+                               'solver': r['solver'], 'ratio': ratio,
+                               'time': r['time'],
+                               'baseline': base[key(r)]['time'] })
+    return slowdowns
+
+def pkg_bench(pkg_name, args):
+    data_modules, model_modules = discover_modules(pkg_name)
+
+    parser = ArgumentParser(prog='bench', description="See README.md.")
+    parser.add_argument('--datasets', metavar='DATASETS', default=None,
+                        type=str, help="Comma separated subset of datasets: %s."
+                                       % ", ".join(data_modules.keys()))
+    parser.add_argument('--models', metavar='MODELS', default=None,
+                        type=str, help="Comma separated subset of models: %s."
+                                       % ", ".join(model_modules.keys()))
+    parser.add_argument('--solver', metavar='SOLVER', default="pdhg",
+                        type=str, help="Solver engine (pdhg|cvx).")
+    parser.add_argument('--data-params', metavar='PARAMS',
+                        default={}, type=str, action=DictAction,
+                        help="Parameters to be passed to the data generators.")
+    parser.add_argument('--solver-params', metavar='PARAMS',
+                        default={}, type=str, action=DictAction,
+                        help="Parameters to be passed to the solver engine.")
+    parser.add_argument('--iterations', metavar='N', default=1000, type=int,
+                        help="Iteration budget per solve (pdhg only).")
+    parser.add_argument('--warmup', metavar='N', default=1, type=int,
+                        help="Number of untimed solves.")
+    parser.add_argument('--repeats', metavar='N', default=3, type=int,
+                        help="Number of timed solves.")
+    parser.add_argument('--report', metavar='REPORT_FILE',
+                        default="bench-%s.json"
+                                % datetime.now().strftime('%Y%m%d%H%M%S'),
+                        type=str, help="Path to JSON report.")
+    parser.add_argument('--compare', metavar='BASELINE_FILE', default=None,
+                        type=str, help="Compare to a previous report.")
+    parser.add_argument('--threshold', metavar='RATIO', default=0.1,
+                        type=float, help="Relative slowdown to be flagged.")
+    pargs = parser.parse_args(args)
+
+    if pargs.datasets is not None:
+        data_modules = { k: data_modules[k] for k in pargs.datasets.split(",") }
+    if pargs.models is not None:
+        model_modules = { k: model_modules[k] for k in pargs.models.split(",") }
+    data_classes = { k: importlib.import_module(v).Data
+                     for k,v in data_modules.items() }
+    model_classes = { k: importlib.import_module(v).Model
+                      for k,v in model_modules.items() }
+
+    report = {
+        'created': datetime.now().isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'iterations': pargs.iterations,
+        'warmup': pargs.warmup,
+        'repeats': pargs.repeats,
+    }
+    report['results'] = run_benchmarks(data_classes, model_classes,
+        solver=pargs.solver, data_params=pargs.data_params,
+        solver_params=pargs.solver_params, iterations=pargs.iterations,
+        warmup=pargs.warmup, repeats=pargs.repeats)
+
+    if pargs.compare is not None:
+        with open(pargs.compare, 'r') as f:
+            baseline = json.load(f)
+        report['slowdowns'] = compare_reports(report, baseline,
+                                              threshold=pargs.threshold)
+        for s in report['slowdowns']:
+            logging.info("SLOWDOWN: model '%s' on dataset '%s': %.3fs vs. "
+                         "%.3fs (x%.2f)" % (s['model'], s['dataset'],
+                         s['time'], s['baseline'], s['ratio']))
+        if len(report['slowdowns']) == 0:
+            logging.info("No slowdowns compared to %s." % pargs.compare)
+
+    with open(pargs.report, 'w') as f:
+        json.dump(report, f, indent=1, default=repr)
+    logging.info("Report written to %s." % pargs.report)
+    return report
@@ -0,0 +1,158 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import glob
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+from repyducible.util import output_dir_create, link_file, remove_file
+
+def _canonical(obj):
+    if isinstance(obj, dict):
+        return "{%s}" % ",".join("%s:%s" % (_canonical(k), _canonical(obj[k]))
+                                 for k in sorted(obj.keys(), key=repr))
+    elif isinstance(obj, (list, tuple)):
+        return "[%s]" % ",".join(_canonical(o) for o in obj)
+    elif isinstance(obj, np.ndarray):
+        return "array(%s,%s,%s)" % (obj.dtype.str, obj.shape,
+                                    hashlib.sha1(obj.tobytes()).hexdigest())
+    else:
+        return repr(obj)
+
+def params_hash(*objs):
+    """ Hash of (nested) parameter dicts that does not depend on dict order.
+
+    Args:
+        objs : dicts, lists, numpy arrays or objects with a deterministic repr
+    Returns:
+        hex digest string
+    """
+    return hashlib.sha1(_canonical(objs).encode("utf-8")).hexdigest()
+
+def file_hash(path, hashobj=None):
+    """ Hash of a file's content (read in chunks).
+
+    Args:
+        path : path to some file
+        hashobj : optional hashlib object to update instead of a new one
+    Returns:
+        the hashlib object
+    """
+    h = hashlib.sha1() if hashobj is None else hashobj
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h
+
+def sample_hash(path, samples=16, size=1 << 16):
+    """ Hash of a file's size and of evenly spaced chunks of its content.
+
+    Unlike `file_hash`, this only reads a bounded amount of data, and is
+    meant as a cheap check against truncated, replaced or regenerated files.
+
+    Args:
+        path : path to some file
+        samples : number of chunks to read
+        size : size of each chunk in bytes
+    Returns:
+        the hashlib object
+    """
+    h = hashlib.sha1()
+    total = os.path.getsize(path)
+    h.update(str(total).encode())
+    with open(path, 'rb') as f:
+        for offset in np.linspace(0, max(0, total - size), samples):
+            f.seek(int(offset))
+            h.update(f.read(size))
+    return h
+
+def default_cache_dir():
+    return os.environ.get("REPYDUCIBLE_CACHE", "")
+
+def default_cache_size():
+    return float(os.environ.get("REPYDUCIBLE_CACHE_SIZE", "0"))
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+class FileCache(object):
+    "Content-addressed store of files, shared by means of hard links"
+    def __init__(self, path):
+        self.path = path
+
+    def entry(self, key, name):
+        return os.path.join(self.path, name, key[:2], key)
+
+    def get(self, key, name, dst):
+        """ Link cache entry `key` of kind `name` to `dst` if it exists.
+
+        Returns:
+            True if the entry exists, False otherwise
+        """
+        entry = self.entry(key, name)
+        if not os.path.exists(entry):
+            return False
+        link_file(entry, dst)
+        os.utime(entry)
+        return True
+
+    def put(self, key, name, src):
+        """ Store file (or directory) `src` as cache entry `key` of kind `name`. """
+        entry = self.entry(key, name)
+        if os.path.exists(entry):
+            return
+        output_dir_create(os.path.dirname(entry))
+        tmp_entry = "%s.tmp-%d" % (entry, os.getpid())
+        try:
+            link_file(src, tmp_entry)
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # a concurrent put may have stored the (directory) entry first
+            remove_file(tmp_entry)
+            if not os.path.exists(entry):
+                raise
+
+    def evict(self, names, max_size):
+        """ Remove least recently used entries until the entries of the given
+        kinds take up at most `max_size` bytes.
+
+        Args:
+            names : list of kinds of entries
+            max_size : size limit in bytes
+        """
+        entries = []
+        for name in names:
+            for entry in glob.glob(os.path.join(self.path, name, "*", "*")):
+                if ".tmp-" not in entry:
+                    entries.append((os.stat(entry).st_mtime, _size(entry), entry))
+        total = sum(e[1] for e in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= max_size:
+                break
+            logging.debug("Evicting cache entry %s." % entry)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            else:
+                os.remove(entry)
+            total -= size
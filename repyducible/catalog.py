@@ -0,0 +1,165 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import glob
+import json
+import sqlite3
+
+from repyducible.util import read_run_manifest, args_from_logs
+
+COLUMNS = ['output_dir', 'dataset', 'model', 'solver', 'status', 'objective',
+           'walltime', 'created', 'updated', 'params', 'args']
+
+QUERY_OPS = ['=', '!=', '<', '<=', '>', '>=', 'like']
+
+def default_catalog_path():
+    return os.environ.get("REPYDUCIBLE_CATALOG", "./results/catalog.sqlite")
+
+class Catalog(object):
+    """ SQLite index of the run manifests of many output directories
+
+    Example:
+        >>> Catalog().query(model="tv", dataset="phantom",
+        ...                 where=[("model.lbd", "<", 0.1)])
+    """
+    def __init__(self, path=None):
+        self.path = default_catalog_path() if path is None else path
+
+    def _connect(self):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.row_factory = sqlite3.Row
+        conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                     "output_dir TEXT PRIMARY KEY, dataset TEXT, model TEXT, "
+                     "solver TEXT, status TEXT, objective REAL, walltime REAL, "
+                     "created TEXT, updated TEXT, params TEXT, args TEXT)")
+        return conn
+
+    def _row(self, row):
+        row = dict(row)
+        for k in ['params', 'args']:
+            row[k] = None if row[k] is None else json.loads(row[k])
+        return row
+
+    def update(self, output_dir, manifest):
+        """ Insert or update the entry of a run.
+
+        Args:
+            output_dir : path to output directory
+            manifest : manifest dict as written by `update_run_manifest`
+        """
+        params = manifest.get('params', None)
+        args = manifest.get('args', None)
+        values = [
+            os.path.abspath(output_dir),
+            manifest.get('dataset', None), manifest.get('model', None),
+            manifest.get('solver', None), manifest.get('status', None),
+            manifest.get('objective', None), manifest.get('walltime', None),
+            manifest.get('created', None), manifest.get('updated', None),
+            None if params is None else json.dumps(params),
+            None if args is None else json.dumps(args),
+        ]
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO runs (%s) VALUES (%s)"
+                % (", ".join(COLUMNS), ", ".join(["?"]*len(COLUMNS))), values)
+        conn.close()
+
+    def get(self, output_dir):
+        """ Entry (dict) of the given output directory or None """
+        conn = self._connect()
+        row = conn.execute("SELECT * FROM runs WHERE output_dir = ?",
+                           (os.path.abspath(output_dir),)).fetchone()
+        conn.close()
+        return None if row is None else self._row(row)
+
+    def query(self, dataset=None, model=None, solver=None, status=None,
+                    where=[]):
+        """ Find runs.
+
+        Args:
+            dataset, model, solver, status : only return runs with these
+                                             values (if not None)
+            where : list of conditions on the params dict of the form
+                    (key, op, value) where key is a dotted path like
+                    "model.lbd" or "solver.term_maxiter" and op is one of
+                    =, !=, <, <=, >, >=, like
+        Returns:
+            list of dicts (one per run), newest runs first
+        """
+        conds, values = [], []
+        for k,v in [('dataset', dataset), ('model', model),
+                    ('solver', solver), ('status', status)]:
+            if v is not None:
+                conds.append("%s = ?" % k)
+                values.append(v)
+        for key, op, value in where:
+            if op not in QUERY_OPS:
+                raise ValueError("Unsupported operator: %s" % op)
+            conds.append("json_extract(params, ?) %s ?" % op)
+            values += ["$.%s" % key, value]
+        sql = "SELECT * FROM runs"
+        if len(conds) > 0:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += " ORDER BY created DESC, output_dir DESC"
+        conn = self._connect()
+        rows = [self._row(r) for r in conn.execute(sql, values)]
+        conn.close()
+        return rows
+
+    def output_dirs(self):
+        """ Sorted list of all output directories in the catalog """
+        conn = self._connect()
+        rows = conn.execute("SELECT output_dir FROM runs ORDER BY output_dir")
+        dirs = [r[0] for r in rows]
+        conn.close()
+        return dirs
+
+    def scan(self, results_dir="./results"):
+        """ Index output directories that are not yet in the catalog.
+
+        Directories without run manifest (written by earlier versions) are
+        indexed using `args_from_logs`. Entries of output directories that
+        no longer exist are removed.
+
+        Args:
+            results_dir : path to directory containing output directories
+        """
+        known = set(self.output_dirs())
+        missing = [d for d in known if not os.path.isdir(d)]
+        if len(missing) > 0:
+            conn = self._connect()
+            with conn:
+                conn.executemany("DELETE FROM runs WHERE output_dir = ?",
+                                 [(d,) for d in missing])
+            conn.close()
+            known -= set(missing)
+        for output_dir in sorted(glob.glob(os.path.join(results_dir, "*"))):
+            if not os.path.isdir(output_dir) \
+               or os.path.abspath(output_dir) in known:
+                continue
+            manifest = read_run_manifest(output_dir)
+            if manifest is None:
+                dataset, model, args = args_from_logs(output_dir)
+                if None in [dataset, model]:
+                    continue
+                manifest = { 'dataset': dataset, 'model': model, 'args': args }
+            self.update(output_dir, manifest)
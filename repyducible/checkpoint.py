@@ -0,0 +1,107 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import glob
+import time
+import logging
+from datetime import datetime
+
+from repyducible.util import data_from_file, data_to_file, remove_file
+
+CHECKPOINT_PATTERN = "checkpoint-*"
+
+# iteration limit of the solvers if `term_maxiter` isn't given
+DEFAULT_MAXITER = int(5e4)
+
+class Checkpointer(object):
+    """ Solver callback that periodically writes crash-safe checkpoints
+
+    A checkpoint holds the post-processed solver state (as in the result
+    file) and the solver's `info` dict (including the iteration). It is
+    written to a temporary file, flushed to disk and renamed, so that a
+    checkpoint file is either complete or doesn't exist. Only the newest
+    `keep` checkpoints are kept.
+
+    Checkpoints are due whenever `every` iterations or `interval` seconds
+    have passed since the last one (if positive). Note that the callback is
+    only called every `granularity` iterations by the solver. Iterations are
+    counted from the first call, so that resumed solves (whose iterations
+    continue from the checkpoint's) don't write a checkpoint right away.
+    """
+    def __init__(self, output_dir, post, format="pickle", every=0, interval=0,
+                       keep=2):
+        self.output_dir = output_dir
+        self.post = post
+        self.format = format
+        self.every = every
+        self.interval = interval
+        self.keep = keep
+        self.last_iter = None
+        self.last_time = time.time()
+
+    def __call__(self, state, info):
+        if self.last_iter is None:
+            self.last_iter = info['iter']
+        due = self.every > 0 and info['iter'] - self.last_iter >= self.every
+        due = due or (self.interval > 0
+                      and time.time() - self.last_time >= self.interval)
+        if due:
+            self.write(state, info)
+
+    def write(self, state, info):
+        write_checkpoint(self.output_dir, self.post(state), dict(info),
+                         format=self.format)
+        self.last_iter = info['iter']
+        self.last_time = time.time()
+        for old in checkpoint_files(self.output_dir)[:-self.keep]:
+            remove_file(old)
+
+def write_checkpoint(output_dir, data, details, format="pickle"):
+    """ Write a checkpoint that `Experiment.solve` resumes from
+
+    Args:
+        output_dir : output directory of the run
+        data : state in the model's output format
+        details : dict of solver details, including the iteration 'iter'
+        format : storage format (see repyducible.util.data_to_file)
+    """
+    path = os.path.join(output_dir, "checkpoint-%s.%s"
+        % (datetime.now().strftime('%Y%m%d%H%M%S%f'), format))
+    data_to_file({ 'data': data, 'details': details },
+                 path, format=format, sync=True)
+    logging.debug("Checkpoint written at iteration %d." % details['iter'])
+
+def checkpoint_files(output_dir):
+    "Checkpoint files of the given output directory, oldest first"
+    paths = glob.glob(os.path.join(output_dir, CHECKPOINT_PATTERN))
+    return sorted(p for p in paths if ".tmp-" not in p and ".old-" not in p)
+
+def latest_checkpoint(output_dir):
+    """ Newest checkpoint in the given output directory that can be loaded.
+
+    Returns:
+        dict with keys 'data' and 'details' or None
+    """
+    for path in reversed(checkpoint_files(output_dir)):
+        format = path.rpartition(".")[2]
+        checkpoint = data_from_file(path, format=format)
+        if checkpoint is not None:
+            return checkpoint
+        logging.info("Skipping invalid checkpoint %s." % path)
+    return None
@@ -16,6 +16,87 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import contextlib
+import numpy as np
+
+from repyducible.cache import file_hash, sample_hash
+
+ARRAYS_DIR = "data-arrays"
+
+_storage_dirs = []
+
+@contextlib.contextmanager
+def storage_dir(path):
+    "Directory in which `Data` objects created in this context store arrays"
+    _storage_dirs.append(path)
+    try:
+        yield path
+    finally:
+        _storage_dirs.pop()
+
+class DiskArray(object):
+    """ Reference to an out-of-core array stored in a .npy file
+
+    Only the file name (relative to the data's storage directory), shape,
+    dtype and checksums are pickled: a hash of the full file content and a
+    cheap one of sampled chunks (see repyducible.cache.sample_hash).
+    """
+    def __init__(self, filename, shape, dtype):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.checksum = None
+        self.sample = None
+
+    def load(self, directory, mmap_mode='r', verify=False):
+        """ Memory-map the array file after checking it against the reference
+
+        By default, only the sampled checksum is compared. With `verify`, the
+        full file content is hashed and compared.
+        """
+        if verify:
+            self.verify(directory)
+        elif getattr(self, 'sample', None) is not None \
+             and self.sample_hash(directory) != self.sample:
+            raise ValueError("Array file %s does not match its checksum." \
+                             % self.filename)
+        arr = np.load(os.path.join(directory, self.filename),
+                      mmap_mode=mmap_mode)
+        if arr.shape != self.shape or arr.dtype != self.dtype:
+            raise ValueError("Array file %s does not match its reference." \
+                             % self.filename)
+        return arr
+
+    def verify(self, directory):
+        "Check the full content of the array file against its checksum"
+        if self.checksum is not None and self.hash(directory) != self.checksum:
+            raise ValueError("Array file %s does not match its checksum." \
+                             % self.filename)
+
+    def hash(self, directory):
+        return file_hash(os.path.join(directory, self.filename)).hexdigest()
+
+    def sample_hash(self, directory):
+        return sample_hash(os.path.join(directory, self.filename)).hexdigest()
+
+def chunks(arr, size, axis=0):
+    """ Iterate over an array in chunks along the given axis
+
+    For memory-mapped arrays, only the current chunk is read from disk.
+
+    Args:
+        arr : numpy array
+        size : number of entries along `axis` per chunk
+        axis : axis to split
+    Returns:
+        generator of tuples (slice, chunk)
+    """
+    for start in range(0, arr.shape[axis], size):
+        sl = slice(start, min(start + size, arr.shape[axis]))
+        index = (slice(None),)*axis + (sl,)
+        yield sl, arr[index]
+
 class Data(object):
     name = ""
     default_params = {
@@ -28,6 +109,99 @@ class Data(object):
         if seed is not None:
             np.random.seed(seed=seed)
 
+    def restrict(self, level):
+        """ Coarser version of this data for multiresolution solves
+
+        Args:
+            level : positive integer, each level usually halves the
+                    resolution
+        Returns:
+            Data instance
+        """
+        raise NotImplementedError("%s does not support restriction."
+                                  % type(self).__name__)
+
+    def split(self, tiles, overlap):
+        """ Split the data into overlapping spatial tiles
+
+        See repyducible.tiling.tile_regions for a regular tiling.
+
+        Args:
+            tiles : tuple, number of tiles along each axis
+            overlap : number of grid points shared by neighbouring tiles
+        Returns:
+            list of pairs (Data instance, region), where the region is a
+            tuple of slices into the full grid
+        """
+        raise NotImplementedError("%s does not support tiling."
+                                  % type(self).__name__)
+
+    def disk_array(self, name, shape, dtype=np.float64):
+        """ Create attribute `name` as an array that lives on disk
+
+        The returned memory-mapped array is writable and should be filled in
+        chunks. When pickled, the data object only stores a reference to the
+        array file. After unpickling, the array is memory-mapped (read-only)
+        on first access, provided that `storage_dir` has been set.
+
+        The array file is created in the data's `storage_dir` or, if unset,
+        in the directory of the enclosing `storage_dir(...)` context.
+
+        Args:
+            name : attribute name
+            shape, dtype : shape and dtype of the array
+        Returns:
+            the memory-mapped array
+        """
+        if self.__dict__.get('storage_dir') is None:
+            if len(_storage_dirs) == 0:
+                raise ValueError("No storage directory for array '%s', create "
+                                 "the data inside storage_dir(...)." % name)
+            self.storage_dir = _storage_dirs[-1]
+        if not os.path.exists(self.storage_dir):
+            os.makedirs(self.storage_dir)
+        ref = DiskArray("%s.npy" % name, shape, dtype)
+        arr = np.lib.format.open_memmap(
+            os.path.join(self.storage_dir, ref.filename),
+            mode='w+', shape=ref.shape, dtype=ref.dtype)
+        self.__dict__.setdefault('disk_arrays', {})[name] = ref
+        setattr(self, name, arr)
+        return arr
+
+    def __getattr__(self, name):
+        refs = self.__dict__.get('disk_arrays', {})
+        if name not in refs or self.__dict__.get('storage_dir') is None:
+            raise AttributeError(name)
+        arr = refs[name].load(self.storage_dir)
+        self.__dict__[name] = arr
+        return arr
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('storage_dir', None)
+        for name, ref in state.get('disk_arrays', {}).items():
+            arr = state.pop(name, None)
+            if isinstance(arr, np.memmap) and arr.mode != 'r':
+                arr.flush()
+                ref.checksum = ref.sample = None
+            if ref.checksum is None:
+                ref.checksum = ref.hash(self.storage_dir)
+            if getattr(ref, 'sample', None) is None:
+                ref.sample = ref.sample_hash(self.storage_dir)
+        return state
+
+    def verify_disk_arrays(self):
+        """ Check the full content of all array files against their checksums
+
+        Loading an array (on first access) only compares a cheap checksum of
+        sampled chunks of its file.
+
+        Raises:
+            ValueError if an array file has been modified
+        """
+        for ref in self.__dict__.get('disk_arrays', {}).values():
+            ref.verify(self.storage_dir)
+
     def apply_default_params(self, params):
         defpall = self.default_params['model'].get('*', {})
         defp = self.default_params['model'].get(params['model_name'], {})
@@ -26,10 +26,7 @@ from argparse import ArgumentParser
 # Import util for propper logging format.
 import repyducible.util
 
-def pkg_demo(pkg_name, args):
-    pkg = importlib.import_module("%s" % pkg_name)
-    Experiment = pkg.Experiment
-
+def discover_modules(pkg_name):
     data_pkg = importlib.import_module("%s.data" % pkg_name)
     pth = data_pkg.__path__
     data_modules = {}
@@ -42,12 +39,22 @@ def pkg_demo(pkg_name, args):
     for _,name,_ in pkgutil.iter_modules(pth):
         model_modules[name] = "%s.models.%s" % (pkg_name, name)
 
+    return data_modules, model_modules
+
+def pkg_demo(pkg_name, args):
+    pkg = importlib.import_module("%s" % pkg_name)
+    Experiment = pkg.Experiment
+    data_modules, model_modules = discover_modules(pkg_name)
     return modules_demo(Experiment, data_modules, model_modules, args)
 
 def modules_demo(Experiment, data_modules, model_modules, args):
-    if 'DISPLAY' in os.environ and len(args) == 0:
+    gui_parser = ArgumentParser(add_help=False)
+    gui_parser.add_argument('--catalog', default=None, type=str)
+    gui_args, other_args = gui_parser.parse_known_args(args)
+    if 'DISPLAY' in os.environ and len(other_args) == 0:
         from repyducible.gui import args_gui
-        args_gui(Experiment, data_modules, model_modules)
+        args_gui(Experiment, data_modules, model_modules,
+                 catalog_path=gui_args.catalog)
         return
 
     if len(args) > 0:
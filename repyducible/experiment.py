@@ -18,20 +18,40 @@
 
 import logging
 import os
-import pickle
 import glob
+import time
+import inspect
 from datetime import datetime
 from argparse import ArgumentParser
 
 from repyducible.util import output_dir_name, output_dir_create, add_log_file,\
-                             backup_source, data_from_file, get_params, \
-                             DictAction, ValidatedDictAction
+                             backup_source, source_files, data_from_file, \
+                             data_to_file, get_params, DictAction, \
+                             ValidatedDictAction, read_run_manifest, \
+                             update_run_manifest, remove_file
+from repyducible.data import ARRAYS_DIR, storage_dir
+from repyducible.snapshots import SnapshotStore, SnapshotWriter, \
+                                  PostSnapshots
+from repyducible.cache import FileCache, file_hash, params_hash, \
+                              default_cache_dir, default_cache_size
+from repyducible.backup import SourceStore
+from repyducible.catalog import Catalog, default_catalog_path
+from repyducible.instrument import OpStats, MetricsRecorder
+from repyducible.profiling import PhaseProfiler
+from repyducible.render import plot_snapshots, spawn_render
+from repyducible.tiling import solve_on_tiles
+from repyducible.stages import StageGraph
+from repyducible.checkpoint import Checkpointer, latest_checkpoint, \
+                                   checkpoint_files, DEFAULT_MAXITER
 
 class Experiment(object):
     name = ""
     extra_source_files = []
+    snapshot_post_params = ["defer_post", "batch_post"]
 
-    def __init__(self, DataClass, ModelClass, args):
+    def __init__(self, DataClass, ModelClass, args, data=None, backup=True):
+        self.profiler = PhaseProfiler()
+        self.profiler.start("args")
         self.DataClass = DataClass
         self.ModelClass = ModelClass
         valid_data_params = get_params(self.DataClass)
@@ -39,6 +59,13 @@ class Experiment(object):
         valid_model_params = get_params(self.ModelClass)
         valid_model_params.remove("data")
         valid_model_params_str = ", ".join(valid_model_params)
+        self.snapshot_store_params = get_params(SnapshotStore)
+        self.snapshot_store_params.remove("path")
+        valid_snapshot_params = get_params(SnapshotWriter)
+        valid_snapshot_params.remove("write")
+        valid_snapshot_params += self.snapshot_store_params
+        valid_snapshot_params += self.snapshot_post_params
+        valid_snapshot_params_str = ", ".join(valid_snapshot_params)
 
         parser = ArgumentParser(prog='', description="See README.md.")
         parser.add_argument('--output', metavar='OUTPUT_DIR',
@@ -60,18 +87,112 @@ class Experiment(object):
                             help="Parameters to be applied to the model. "
                                  "Valid parameters: %s" % valid_model_params_str)
         parser.add_argument('--solver', metavar='SOLVER', default="pdhg",
-                            type=str, help="Solver engine (pdhg|cvx).")
+                            type=str, help="Solver engine (pdhg|cvx|portfolio|staged). "
+                                 "The portfolio races the engines given by "
+                                 "the solver parameter 'engines' (pdhg or "
+                                 "CVXPY backends) against each other. "
+                                 "The staged solver runs the engines given "
+                                 "by the solver parameter 'stages' one after "
+                                 "another, each warm-started from the "
+                                 "previous one.")
         parser.add_argument('--solver-params', metavar='PARAMS',
                             default={}, type=str, action=DictAction,
                             help="Parameters to be passed to the solver engine.")
         parser.add_argument('--snapshots', action="store_true", default=False,
                             help="Store snapshots of solver iteration. "
                                  "Only available for pdhg solver.")
+        parser.add_argument('--snapshot-params', metavar='PARAMS',
+                            default={}, type=str,
+                            action=ValidatedDictAction(valid_snapshot_params),
+                            help="Parameters of the background snapshot "
+                                 "writer and retention policy. With "
+                                 "defer_post=True, raw solver states are "
+                                 "stored and the model's post() is applied "
+                                 "when a snapshot is read. With batch_post=N, "
+                                 "post() is applied to all snapshots by N "
+                                 "threads at the end of the run. "
+                                 "Valid parameters: %s"
+                                 % valid_snapshot_params_str)
+        parser.add_argument('--levels', metavar='LEVELS', default=1, type=int,
+                            help="Solve on LEVELS-1 coarser versions of the "
+                                 "data first (coarsest first), each warm-"
+                                 "started from the prolongated result of the "
+                                 "previous level. Requires Data.restrict "
+                                 "and Model.prolong.")
+        parser.add_argument('--tiles', metavar='TILES', default="", type=str,
+                            help="Split the data into overlapping tiles "
+                                 "(e.g. 4x4), solve them in parallel and "
+                                 "stitch the results. Requires Data.split "
+                                 "and Model.stitch.")
+        parser.add_argument('--tile-overlap', metavar='POINTS', default=8,
+                            type=int, help="Overlap of neighbouring tiles.")
+        parser.add_argument('--tile-processes', metavar='PROCESSES',
+                            default=None, type=int,
+                            help="Number of processes solving tiles "
+                                 "(default: number of CPUs).")
+        parser.add_argument('--tile-refine', metavar='ITERATIONS', default=0,
+                            type=int,
+                            help="Refine the stitched result with a global "
+                                 "solve of at most ITERATIONS iterations.")
+        parser.add_argument('--checkpoint-every', metavar='ITERATIONS',
+                            default=0, type=int,
+                            help="Write a checkpoint of the solver state "
+                                 "every ITERATIONS iterations.")
+        parser.add_argument('--checkpoint-interval', metavar='SECONDS',
+                            default=0, type=float,
+                            help="Write a checkpoint of the solver state "
+                                 "every SECONDS seconds.")
+        parser.add_argument('--storage', metavar='FORMAT', default="pickle",
+                            type=str, choices=["pickle", "mmap"],
+                            help="Storage format for data and results "
+                                 "(pickle|mmap). With mmap, numpy arrays are "
+                                 "stored as .npy files and memory-mapped "
+                                 "lazily when loaded.")
+        parser.add_argument('--cache', metavar='CACHE_DIR',
+                            default=default_cache_dir(), type=str,
+                            help="Path to a cache directory shared between "
+                                 "runs (default: $REPYDUCIBLE_CACHE). "
+                                 "Results of runs with identical parameters "
+                                 "and source code are reused, generated data "
+                                 "is shared and source backups are "
+                                 "deduplicated.")
+        parser.add_argument('--cache-size', metavar='BYTES',
+                            default=default_cache_size(), type=float,
+                            help="Size limit for cached data "
+                                 "(default: $REPYDUCIBLE_CACHE_SIZE or 0, "
+                                 "i.e. no limit). Least recently used "
+                                 "entries are evicted first.")
+        parser.add_argument('--catalog', metavar='CATALOG_FILE',
+                            default=default_catalog_path(), type=str,
+                            help="Path to the SQLite catalog of runs "
+                                 "(default: $REPYDUCIBLE_CATALOG or "
+                                 "./results/catalog.sqlite). "
+                                 "Use an empty string to disable.")
+        parser.add_argument('--instrument', action="store_true", default=False,
+                            help="Record timings of the PDHG operators and "
+                                 "per-iteration metrics (metrics.csv).")
+        parser.add_argument('--profile-memory', action="store_true",
+                            default=False,
+                            help="Trace memory allocations of each phase "
+                                 "(profile.json) using tracemalloc.")
+        parser.add_argument('--render', metavar='MODE', default="inline",
+                            type=str, choices=["inline", "background"],
+                            help="Run postprocessing and plotting in this "
+                                 "process (inline) or in a detached process "
+                                 "so that this one can exit (background).")
+        parser.add_argument('--render-processes', metavar='PROCESSES',
+                            default=1, type=int,
+                            help="Number of processes rendering snapshot "
+                                 "frames (only with plot mode hide|no).")
         parser.add_argument('--test', action="store_true", default=False,
                             help="Run PDHG model tests.")
         parser.add_argument('-v', action="store_true", default=False,
                             help="Verbose logs to standard output.")
         self.pargs = parser.parse_args(args)
+        if self.pargs.levels > 1 and self.pargs.tiles != "":
+            parser.error("--levels and --tiles can't be combined.")
+        if self.pargs.profile_memory:
+            self.profiler.enable_tracing()
 
         if self.pargs.output == '':
             self.output_dir = "%s-%s" % (DataClass.name, ModelClass.name)
@@ -85,12 +206,55 @@ class Experiment(object):
 
         output_dir_create(self.output_dir)
         add_log_file(logging.getLogger(), self.output_dir)
-        backup_source(self, self.output_dir, extra=self.extra_source_files)
+        self.profiler.start("backup")
+        self.cache = None
+        if self.pargs.cache == '':
+            if backup:
+                backup_source(self, self.output_dir,
+                              extra=self.extra_source_files)
+        else:
+            self.cache = FileCache(self.pargs.cache)
+            store = SourceStore(os.path.join(self.pargs.cache, "source"))
+            files = source_files(self, extra=self.extra_source_files)
+            if backup:
+                manifest = store.backup(files, self.output_dir)
+            else:
+                manifest = store.manifest(files)
+            self.source_hash = manifest['hash']
         logging.debug("Args: %s" % args)
 
+        self.catalog = None
+        if self.pargs.catalog != '':
+            self.catalog = Catalog(self.pargs.catalog)
+        manifest = read_run_manifest(self.output_dir)
+        self.stages = StageGraph(None if manifest is None
+                                 else manifest.get('stages', None))
+        self.solve_origin = None if manifest is None \
+                            else manifest.get('solve_origin', None)
+        self.resume_iter = 0 if manifest is None \
+                           else manifest.get('resume_iter', 0)
+        if manifest is None:
+            self.update_manifest(
+                dataset=self.DataClass.__module__.rpartition(".")[2],
+                model=self.ModelClass.__module__.rpartition(".")[2],
+                args=args, created=datetime.now().isoformat(),
+                status="created")
+
         self.init_params()
-        self.restore_data()
+        self.profiler.start("data")
+        self.restore_data(data)
         self.restore_params()
+        self.profiler.stop()
+
+    def update_manifest(self, **fields):
+        """ Update the run manifest and the catalog entry of this run """
+        fields['updated'] = datetime.now().isoformat()
+        manifest = update_run_manifest(self.output_dir, **fields)
+        if self.catalog is not None:
+            try:
+                self.catalog.update(self.output_dir, manifest)
+            except Exception:
+                logging.exception("Updating the catalog failed.")
 
     def init_params(self):
         self.params = {
@@ -105,61 +269,468 @@ class Experiment(object):
         params = data_from_file(self.params_file, format="pickle")
         if params is not None:
             self.params.update(params)
+            self.params['data'].update(self.pargs.data_params)
 
-    def restore_data(self):
+    def restore_data(self, data=None):
+        params_file = os.path.join(self.output_dir, 'params.pickle')
+        params = data_from_file(params_file, format="pickle")
+        if params is not None:
+            self.params['data'].update(params['data'])
         self.params['data'].update(self.pargs.data_params)
-        self.data_file = os.path.join(self.output_dir, 'data.pickle')
-        self.data = data_from_file(self.data_file, format="pickle")
+        self.data_file, data_format = self.output_file('data')
+        arrays_dir = os.path.join(self.output_dir, ARRAYS_DIR)
+        data_key = self.stages.add("data", inputs={
+            'class': "%s.%s" % (self.DataClass.__module__,
+                                self.DataClass.__name__),
+            'params': self.params['data'],
+            'source': self.source_file_hash(self.DataClass),
+        })
+        if data is None and not self.stages.valid("data"):
+            logging.info("Inputs of the data stage changed, "
+                         "regenerating data.")
+            remove_file(self.data_file)
+            remove_file(arrays_dir)
+        self.update_manifest(stages=self.stages.record("data"))
+        self.data = data
         if self.data is None:
-            self.data = self.DataClass(**self.params['data'])
-            with open(self.data_file, 'wb') as f:
-                pickle.dump(self.data, f)
+            self.data = data_from_file(self.data_file, format=data_format)
+        if self.data is None and self.cache is not None:
+            cache_kind = os.path.basename(self.data_file)
+            arrays_kind = "%s.%s" % (ARRAYS_DIR, data_format)
+            if self.cache.get(data_key, cache_kind, self.data_file):
+                logging.info("Using cached data %s." % data_key)
+                self.cache.get(data_key, arrays_kind, arrays_dir)
+                self.data = data_from_file(self.data_file, format=data_format)
+                if len(self.data.__dict__.get('disk_arrays', {})) > 0 \
+                   and not os.path.exists(arrays_dir):
+                    self.data = None
+        if self.data is None:
+            with storage_dir(arrays_dir):
+                self.data = self.DataClass(**self.params['data'])
+            data_to_file(self.data, self.data_file, format=data_format)
+            if self.cache is not None:
+                self.cache.put(data_key, cache_kind, self.data_file)
+                if os.path.exists(arrays_dir):
+                    self.cache.put(data_key, arrays_kind, arrays_dir)
+                if self.pargs.cache_size > 0:
+                    self.cache.evict(["data.pickle", "data.mmap",
+                                      "%s.pickle" % ARRAYS_DIR,
+                                      "%s.mmap" % ARRAYS_DIR],
+                                     self.pargs.cache_size)
+        elif data is None:
+            self.data.storage_dir = arrays_dir
         self.data.apply_default_params(self.params)
 
+    def source_file_hash(self, cls):
+        return file_hash(inspect.getsourcefile(cls)).hexdigest()
+
+    def add_stages(self):
+        """ Declare the stages downstream of the data and their inputs
+
+        The solve stage also depends on the source hash of the whole
+        package if a cache is used (see `--cache`), and on the state a
+        solve was continued from (if any, see `solve_origin`).
+        """
+        p = self.input_params()
+        self.stages.add("model", inputs={
+            'class': "%s.%s" % (self.ModelClass.__module__,
+                                self.ModelClass.__name__),
+            'params': p['model'],
+            'source': self.source_file_hash(self.ModelClass),
+        }, deps=["data"])
+        self.stages.add("setup", inputs={ 'solver': p['solver_name'] },
+                        deps=["model"])
+        solve_inputs = { 'params': p['solver'],
+                         'source': getattr(self, 'source_hash', None) }
+        if self.pargs.levels > 1:
+            solve_inputs['levels'] = self.pargs.levels
+        if self.pargs.tiles != "":
+            solve_inputs['tiles'] = (self.pargs.tiles, self.pargs.tile_overlap,
+                                     self.pargs.tile_refine)
+        if self.solve_origin is not None:
+            solve_inputs['origin'] = self.solve_origin
+        self.stages.add("solve", inputs=solve_inputs, deps=["setup"])
+        self.stages.add("postprocessing", deps=["solve"])
+        self.stages.add("plot", inputs={ 'params': p['plot'],
+                                         'mode': self.pargs.plot },
+                        deps=["postprocessing"])
+
+    def output_file(self, name):
+        """ Path and format of output file `name`
+
+        Existing files are used in whichever format they were stored,
+        otherwise the format given by `--storage` applies.
+        """
+        formats = [self.pargs.storage] \
+                + [f for f in ["pickle", "mmap"] if f != self.pargs.storage]
+        for format in formats:
+            path = os.path.join(self.output_dir, "%s.%s" % (name, format))
+            if os.path.exists(path):
+                return path, format
+        path = os.path.join(self.output_dir, "%s.%s" % (name, formats[0]))
+        return path, formats[0]
+
     def run(self):
+        self.update_manifest(status="running")
+        t0 = time.time()
+        try:
+            self.solve()
+            if self.pargs.render == "inline":
+                self.render()
+        except BaseException:
+            self.update_manifest(status="failed", walltime=time.time() - t0)
+            raise
+        finally:
+            self.profiler.write(os.path.join(self.output_dir, "profile.json"))
+            logging.info(self.profiler.summary())
+        details = self.result['details']
+        self.update_manifest(status="done", walltime=time.time() - t0,
+                             objective=details.get('objp', None))
+        if self.pargs.render == "background":
+            spawn_render(self)
+
+    def solve(self):
         self.params['model'].update(self.pargs.model_params)
         self.params['solver'].update(self.pargs.solver_params)
-        with open(self.params_file, 'wb') as f:
-            pickle.dump(self.params, f)
+        data_to_file(self.params, self.params_file, format="pickle")
+        self.update_manifest(solver=self.params['solver_name'],
+                             params=self.input_params())
 
+        self.profiler.start("model")
+        self.add_stages()
         self.model = self.ModelClass(self.data, **self.params['model'])
 
-        self.result_file = os.path.join(self.output_dir, 'result.pickle')
-        self.result = data_from_file(self.result_file, format="pickle")
+        self.snapshot_path = os.path.join(self.output_dir, 'snapshots')
+        self.result_file, result_format = self.output_file('result')
+        self.result = data_from_file(self.result_file, format=result_format)
+        resume_iter = 0
+        if not self.stages.valid("solve"):
+            logging.info("Inputs of stages %s changed, the result is "
+                         "outdated." % ", ".join(self.stages.invalidated()))
+            if self.result is not None and self.pargs.resume:
+                self.params['solver']['continue_at'] = self.result['data']
+                resume_iter = self.result['details'].get('iter', 0)
+            self.result = None
+            remove_file(self.result_file)
+            for path in checkpoint_files(self.output_dir):
+                remove_file(path)
+        self.update_manifest(stages=self.stages.record("model", "setup",
+                                                       "solve"))
+
+        # results resumed from an outdated result don't match the solve key
+        cache_result = self.cache is not None and self.result is None \
+                       and not self.pargs.snapshots \
+                       and 'continue_at' not in self.params['solver']
+        cache_kind = os.path.basename(self.result_file)
+        if cache_result:
+            self.result_key = self.stages.key("solve")
+            if self.cache.get(self.result_key, cache_kind, self.result_file):
+                logging.info("Using cached result %s." % self.result_key)
+                self.result = data_from_file(self.result_file,
+                                             format=result_format)
+                cache_result = False
+
+        checkpoint = None
+        if self.result is None:
+            checkpoint = latest_checkpoint(self.output_dir)
+            if checkpoint is not None:
+                logging.info("Resuming from checkpoint at iteration %d."
+                             % checkpoint['details']['iter'])
+                self.params['solver']['continue_at'] = checkpoint['data']
+                cache_result = False
 
         if self.result is not None:
             self.params['solver']['continue_at'] = self.result['data']
+            resume_iter = self.result['details'].get('iter', 0)
 
         if self.result is None or self.pargs.resume:
-            self.model.setup_solver(self.pargs.solver)
-            if self.pargs.test and self.pargs.solver == "pdhg":
-                self.model.run_pdhg_tests()
+            # outputs of a solve continued from an earlier state (--resume
+            # or a checkpoint) differ from those of a fresh solve
+            self.solve_origin = None
+            if 'continue_at' in self.params['solver']:
+                self.solve_origin = params_hash(self.stages.key("solve"),
+                    self.params['solver']['continue_at'])
+            if checkpoint is None:
+                # iterations of the result the solve is continued from
+                self.resume_iter = resume_iter
+            self.add_stages()
+            self.update_manifest(solve_origin=self.solve_origin,
+                resume_iter=self.resume_iter,
+                stages=self.stages.record("model", "setup", "solve"))
+            levels, tiles = [], []
+            if self.pargs.levels > 1 \
+               and 'continue_at' not in self.params['solver']:
+                self.profiler.start("coarse levels")
+                levels = self.solve_coarse_levels()
+            elif self.pargs.tiles != "" \
+                 and 'continue_at' not in self.params['solver']:
+                self.profiler.start("tiles")
+                tiles = self.solve_tiles()
             params = self.params['solver']
+            if len(tiles) > 0:
+                params = dict(params, term_maxiter=self.pargs.tile_refine)
+            start_iter = self.resume_iter
+            if checkpoint is not None:
+                start_iter = checkpoint['details']['iter']
+                maxiter = params.get('term_maxiter', DEFAULT_MAXITER) \
+                          - (start_iter - self.resume_iter)
+                params = dict(params, term_maxiter=max(0, maxiter))
+            solve_full = params.get('term_maxiter', DEFAULT_MAXITER) > 0 \
+                         or (checkpoint is None and len(tiles) == 0)
+            stats = None
+            if solve_full:
+                self.profiler.start("setup")
+                if self.pargs.instrument:
+                    stats = OpStats()
+                    self.model.setup_solver(self.pargs.solver, stats=stats)
+                else:
+                    self.model.setup_solver(self.pargs.solver)
+                if self.pargs.test and self.pargs.solver == "pdhg":
+                    self.model.run_pdhg_tests()
+            callbacks = []
             if self.pargs.snapshots:
-                params = dict(params, cbfun=self.store_snapshot)
-            details = self.model.solve(params)
+                store_params, writer_params, post_params = {}, {}, {}
+                for k,v in self.pargs.snapshot_params.items():
+                    if k in self.snapshot_store_params:
+                        store_params[k] = v
+                    elif k in self.snapshot_post_params:
+                        post_params[k] = v
+                    else:
+                        writer_params[k] = v
+                batch_post = post_params.get('batch_post', 0)
+                self.defer_post = post_params.get('defer_post', False) \
+                                  or batch_post > 0
+                self.snapshot_store = SnapshotStore(self.snapshot_path,
+                                                    **store_params).open()
+                # snapshots beyond the state continued from are recomputed
+                self.snapshot_store.truncate(start_iter)
+                snapshot_writer = SnapshotWriter(self.store_snapshot,
+                                                 **writer_params)
+                callbacks.append(snapshot_writer)
+            if self.pargs.instrument:
+                metrics = MetricsRecorder(os.path.join(self.output_dir,
+                                                       "metrics.csv"),
+                                          append=start_iter > 0)
+                callbacks.append(metrics)
+            if self.pargs.checkpoint_every > 0 \
+               or self.pargs.checkpoint_interval > 0:
+                callbacks.append(Checkpointer(self.output_dir, self.model.post,
+                    format=result_format, every=self.pargs.checkpoint_every,
+                    interval=self.pargs.checkpoint_interval))
+            if len(callbacks) > 0:
+                def cbfun(state, info):
+                    if start_iter > 0:
+                        # count iterations from the start of the original solve
+                        info = dict(info, iter=start_iter + info['iter'])
+                    for cb in callbacks:
+                        cb(state, info)
+                params = dict(params, cbfun=cbfun)
+            self.profiler.start("solve")
+            t_solve = time.time()
+            try:
+                if solve_full:
+                    details = self.model.solve(params)
+                else:
+                    # stitched tiles or a checkpoint without iterations left
+                    self.model.solver_name = self.pargs.solver
+                    self.model.state = self.params['solver'].pop('continue_at')
+                    details = { 'status': "stitched" } if checkpoint is None \
+                              else dict(checkpoint['details'])
+            finally:
+                if self.pargs.snapshots:
+                    snapshot_writer.close()
+                    self.snapshot_store.close()
+                if self.pargs.instrument:
+                    metrics.close()
+            if start_iter > 0 and solve_full and 'iter' in details:
+                details['iter'] += start_iter
+            if stats is not None:
+                stats.log()
+                details['instrumentation'] = stats.summary()
+            if len(tiles) > 0:
+                details['tiles'] = tiles
+            if len(levels) > 0:
+                details['levels'] = levels + [{ 'level': 0,
+                    'iter': details.get('iter', None),
+                    'objp': details.get('objp', None),
+                    'time': time.time() - t_solve }]
             self.result = {
                 'data': self.model.state,
                 'details': details,
             }
-            with open(self.result_file, 'wb') as f:
-                pickle.dump(self.result, f)
+            data_to_file(self.result, self.result_file, format=result_format)
+            if self.pargs.snapshots and batch_post > 0:
+                self.profiler.start("snapshot post")
+                logging.info("Post-processing snapshots...")
+                SnapshotStore(self.snapshot_path).rewrite(self.post_snapshot,
+                                                          batch_post)
+            for path in checkpoint_files(self.output_dir):
+                remove_file(path)
+            if cache_result:
+                self.cache.put(self.result_key, cache_kind, self.result_file)
+
+    def solve_coarse_levels(self):
+        """ Solve on restricted versions of the data, coarsest level first
+
+        The result of each level is prolongated to the next finer level
+        and used as its initial state. The prolongation of the finest
+        coarse level is passed to the full resolution solve.
+
+        Returns:
+            list of dicts with iteration count, objective and time per level
+        """
+        state, coarse, records = None, None, []
+        for level in range(self.pargs.levels - 1, 0, -1):
+            t0 = time.time()
+            model = self.ModelClass(self.data.restrict(level),
+                                    **self.params['model'])
+            params = dict(self.params['solver'])
+            if coarse is not None:
+                params['continue_at'] = model.prolong(state, coarse)
+            model.setup_solver(self.pargs.solver)
+            details = model.solve(params)
+            state, coarse = model.state, model
+            records.append({ 'level': level, 'iter': details.get('iter', None),
+                             'objp': details.get('objp', None),
+                             'time': time.time() - t0 })
+            logging.info("Level %d: %s iterations in %.2fs, objective: %s"
+                         % (level, records[-1]['iter'], records[-1]['time'],
+                            records[-1]['objp']))
+        self.params['solver']['continue_at'] = self.model.prolong(state, coarse)
+        return records
 
+    def solve_tiles(self):
+        """ Solve the model on overlapping tiles of the data in parallel
+
+        The tile states are stitched by the model (see Data.split and
+        PDBaseModel.stitch) and the result is used as initial state of the
+        global solve.
+
+        Returns:
+            list of dicts with region, iteration count, objective and time
+            per tile
+        """
+        tiles = tuple(int(n) for n in self.pargs.tiles.split("x"))
+        overlap = self.pargs.tile_overlap
+        pieces = self.data.split(tiles, overlap)
+        logging.info("Solving %d tiles..." % len(pieces))
+        results = solve_on_tiles(self.ModelClass, self.params['model'],
+                                 [d for d,_ in pieces], self.pargs.solver,
+                                 self.params['solver'],
+                                 processes=self.pargs.tile_processes)
+        records = []
+        for (_, region), (details, _) in zip(pieces, results):
+            records.append({ 'region': [(sl.start, sl.stop) for sl in region],
+                             'iter': details.get('iter', None),
+                             'objp': details.get('objp', None),
+                             'time': details['time'] })
+            logging.info("Tile %s: %s iterations in %.2fs, objective: %s"
+                         % (records[-1]['region'], records[-1]['iter'],
+                            records[-1]['time'], records[-1]['objp']))
+        self.params['solver']['continue_at'] = self.model.stitch(
+            [state for _, state in results], [r for _,r in pieces], overlap)
+        return records
+
+    def load_snapshots(self):
         self.snapshots = []
         if self.pargs.snapshots:
-            snapshot_path = os.path.join(self.output_dir, "snapshot-*.pickle")
-            for snap in sorted(glob.glob(snapshot_path)):
-                self.snapshots.append(data_from_file(snap, format="pickle"))
+            self.snapshots = PostSnapshots(SnapshotStore(self.snapshot_path),
+                                           self.post_snapshot)
+            if len(self.snapshots) == 0:
+                # snapshots stored by earlier versions as separate files
+                snapshot_path = os.path.join(self.output_dir, "snapshot-*.pickle")
+                self.snapshots = [data_from_file(snap, format="pickle")
+                                  for snap in sorted(glob.glob(snapshot_path))]
+
+    def input_params(self):
+        "Copy of `self.params` without state passed to the solver at runtime"
+        params = dict(self.params)
+        params['solver'] = { k: v for k,v in params['solver'].items()
+                             if k not in ['continue_at', 'cbfun'] }
+        return params
+
+    def store_snapshot(self, state, info):
+        if self.defer_post:
+            outdata = { 'data': state, 'details': info,
+                        'raw': self.model.solver_name }
+        else:
+            outdata = { 'data': self.model.post(state), 'details': info }
+        self.snapshot_store.append(info['iter'], outdata)
+
+    def post_snapshot(self, snapshot):
+        "Apply the model's post() to a snapshot stored with `defer_post`"
+        if 'raw' not in snapshot:
+            return snapshot
+        snapshot = dict(snapshot)
+        if snapshot.pop('raw') == "cvx":
+            snapshot['data'] = self.model.post_cvx(snapshot['data'])
+        else:
+            snapshot['data'] = self.model.post_pdhg(snapshot['data'])
+        return snapshot
 
+    def render(self):
+        self.profiler.start("snapshots")
+        self.load_snapshots()
+        self.profiler.start("postprocessing")
         self.postprocessing()
+        self.profiler.start("plot")
         self.plot()
+        self.update_manifest(stages=self.stages.record("postprocessing",
+                                                       "plot"))
+        if type(self).plot_snapshot is not Experiment.plot_snapshot:
+            self.profiler.start("frames")
+            plot_snapshots(self, self.pargs.render_processes)
+        self.profiler.stop()
 
-    def store_snapshot(self, state, info):
-        outfile = os.path.join(self.output_dir, "snapshot-%s-%d.pickle"
-            % (datetime.now().strftime('%Y%m%d%H%M%S'), info['iter']))
-        outdata = { 'data': self.model.post(state), 'details': info }
-        with open(outfile, 'wb') as f:
-            pickle.dump(outdata, f)
+    def score(self):
+        """ Score of the result used for ranking runs (lower is better)
+
+        Required by repyducible.sweep.search. Subclasses return e.g. an
+        error measure computed in `postprocessing`. There is no default
+        (None): the solver's objective isn't comparable across model
+        parameters (e.g. regularization weights) that change the objective
+        itself.
+        """
+        return None
+
+    def memoize(self, stage, name, compute, format="pickle"):
+        """ Output `name` of `stage`, computed by `compute()` only if needed
+
+        The output is stored in the output directory and in the cache (if
+        any) under the key of the stage, so it is only recomputed if some
+        input of the stage or of a stage upstream of it has changed.
+
+        Args:
+            stage : name of the stage the output belongs to, e.g.
+                    "postprocessing"
+            name : name of the output file (without extension)
+            compute : function without arguments that computes the output
+            format : storage format (see util.data_to_file)
+        Returns:
+            the output
+        """
+        path = os.path.join(self.output_dir, "%s.%s" % (name, format))
+        key, kind = self.stages.key(stage), os.path.basename(path)
+        value = None
+        if self.stages.valid(stage):
+            value = data_from_file(path, format=format)
+        if value is None and self.cache is not None \
+           and self.cache.get(key, kind, path):
+            value = data_from_file(path, format=format)
+        if value is None:
+            value = compute()
+            data_to_file(value, path, format=format)
+            if self.cache is not None:
+                self.cache.put(key, kind, path)
+        return value
 
     def postprocessing(self): pass
     def plot(self): pass
+
+    def plot_snapshot(self, i, snapshot):
+        """ Render a frame for snapshot number `i` (called after `plot`).
+
+        Frames are rendered in parallel with --render-processes, so
+        implementations should only write to files specific to `i`.
+        """
+        pass
@@ -13,6 +13,7 @@ import tkinter.ttk as ttk
 
 from repyducible.demo import modules_demo
 from repyducible.util import get_params, args_from_logs
+from repyducible.catalog import Catalog
 
 class ArgChooser(object):
     def __init__(self, master, argname=""):
@@ -147,7 +148,7 @@ class DictArgChooser(ArgChooser):
         result = ",".join(vals).replace('"', "'")
         return ['%s' % result]
 
-def args_gui(Experiment, data_modules, model_modules):
+def args_gui(Experiment, data_modules, model_modules, catalog_path=None):
     def destroy_cb(*args):
         root.quit()
         root.destroy()
@@ -211,6 +212,8 @@ def args_gui(Experiment, data_modules, model_modules):
 
     def b_go_cb():
         cmd = ["python", "demo.py"] + parse_commandline()
+        if catalog_path is not None:
+            cmd += ["--catalog", catalog_path]
         root.after_idle(lambda root=root, cmd=cmd: popen_with_stdout(root, cmd))
 
     def b_reset_cb():
@@ -227,7 +230,12 @@ def args_gui(Experiment, data_modules, model_modules):
     fr = ttk.Frame(root, padding=(5, 5, 12, 12))
     fr.grid(column=0, row=0, sticky=(tk.N, tk.E, tk.S, tk.W))
 
-    output_dirs = sorted(glob.glob("./results/*"))
+    try:
+        catalog = Catalog(catalog_path)
+        catalog.scan()
+        output_dirs = [os.path.relpath(d) for d in catalog.output_dirs()]
+    except Exception:
+        output_dirs = sorted(glob.glob("./results/*"))
     datasets = sorted(list(data_modules.keys()))
     models = sorted(list(model_modules.keys()))
     choosers = [
@@ -0,0 +1,134 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import csv
+import time
+import logging
+import numpy as np
+
+def _nbytes(args):
+    return sum(a.nbytes for a in args if isinstance(a, np.ndarray))
+
+class OpStats(object):
+    "Call counts, wall time and bytes touched, per operator name"
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, name, dt, nbytes):
+        s = self.stats.setdefault(name, { 'calls': 0, 'time': 0.0, 'bytes': 0 })
+        s['calls'] += 1
+        s['time'] += dt
+        s['bytes'] += nbytes
+
+    def summary(self):
+        return { name: dict(s, time_per_call=s['time']/max(1, s['calls']))
+                 for name, s in self.stats.items() }
+
+    def log(self):
+        for name, s in sorted(self.summary().items()):
+            logging.info("%-20s %8d calls %10.3fs %10.3fms/call %10.1f MB"
+                % (name, s['calls'], s['time'], 1000*s['time_per_call'],
+                   s['bytes']/1e6))
+
+class InstrumentedOp(object):
+    """ Proxy for an opymize operator that records the time spent in calls
+
+    Only calls through `__call__` are recorded (e.g. not GPU kernels that a
+    solver launches directly). All other attributes are passed through.
+    """
+    def __init__(self, op, name, stats):
+        self.op = op
+        self.name = name
+        self.stats = stats
+
+    def __call__(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = self.op(*args, **kwargs)
+        self.stats.add(self.name, time.perf_counter() - t0, _nbytes(args))
+        return result
+
+    @property
+    def adjoint(self):
+        return InstrumentedOp(self.op.adjoint, "%s.adjoint" % self.name,
+                              self.stats)
+
+    def __getattr__(self, attr):
+        return getattr(self.op, attr)
+
+class InstrumentedFunctional(InstrumentedOp):
+    "Proxy for an opymize functional whose proximal operators are recorded"
+    def prox(self, *args, **kwargs):
+        return InstrumentedOp(self.op.prox(*args, **kwargs),
+                              "%s.prox" % self.name, self.stats)
+
+    @property
+    def conj(self):
+        return InstrumentedFunctional(self.op.conj, "%s.conj" % self.name,
+                                      self.stats)
+
+class MetricsRecorder(object):
+    """ Solver callback that appends iteration, wall time and all numeric
+    values of the solver's `info` dict to a CSV file
+
+    With `append`, rows are added to an existing file (e.g. when resuming
+    from a checkpoint), using the columns of its header. Existing rows from
+    the first recorded iteration onwards are dropped, since they are
+    recomputed.
+    """
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append
+        self.f = None
+        self.t0 = time.time()
+        self.tlast = self.t0
+
+    def __call__(self, state, info):
+        t = time.time()
+        row = { k: v for k,v in info.items()
+                if isinstance(v, (int, float, np.number)) }
+        row.update(time=t - self.t0, dt=t - self.tlast)
+        self.tlast = t
+        if self.f is None:
+            fields, rows = None, []
+            if self.append and os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    reader = csv.DictReader(f)
+                    fields = reader.fieldnames
+                    rows = [r for r in reader
+                            if float(r['iter']) < row.get('iter', np.inf)]
+            if fields is None:
+                self.f = open(self.path, 'w')
+                fields = ['iter', 'time', 'dt'] \
+                       + sorted(k for k in row.keys() if k not in ['iter', 'time', 'dt'])
+                self.writer = csv.DictWriter(self.f, fieldnames=fields,
+                                             extrasaction='ignore')
+                self.writer.writeheader()
+            else:
+                self.f = open(self.path, 'w')
+                self.writer = csv.DictWriter(self.f, fieldnames=fields,
+                                             extrasaction='ignore')
+                self.writer.writeheader()
+                self.writer.writerows(rows)
+        self.writer.writerow(row)
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
@@ -16,9 +16,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import copy
+import time
 import logging
+import collections
+import multiprocessing
+import multiprocessing.connection
 import numpy as np
 
+# canonicalized CVX problems, see PDBaseModel.cvx_cache_key
+CVX_CACHE_SIZE = 8
+_cvx_cache = collections.OrderedDict()
+
+# solver options of CVXPY backends that correspond to `term_relgap`
+CVX_ACCURACY_PARAMS = {
+    'SCS': ['eps_rel'],
+    'ECOS': ['reltol'],
+    'CLARABEL': ['tol_gap_rel'],
+    'OSQP': ['eps_rel'],
+}
+
 class CvxSolver(object):
     "Wrapper for cvx.Problem for use with PDBaseModel"
     def __init__(self, obj, variables, constraints):
@@ -30,10 +47,16 @@ class CvxSolver(object):
         self.x = np.zeros(sum(v.size for v in self.variables))
         self.y = np.zeros(sum(c.size for c in self.constraints))
 
-    def solve(self, continue_at=None):
+    def solve(self, continue_at=None, cvx_solver="MOSEK", verbose=True,
+                    **kwargs):
+        """ Solve the problem using the CVXPY backend `cvx_solver`.
+
+        Additional keyword arguments are passed to the backend.
+        """
         if continue_at is not None:
             self.init_vars(*continue_at)
-        self.prob.solve(verbose=True, warm_start=True, solver="MOSEK")
+        self.prob.solve(verbose=verbose, warm_start=True, solver=cvx_solver,
+                        **kwargs)
         if self.prob.status not in ["infeasible", "unbounded"]:
             self.x[:] = np.hstack([v.value.ravel() for v in self.variables])
             self.y[:] = np.hstack([c.dual_value.ravel() for c in self.constraints])
@@ -41,6 +64,12 @@ class CvxSolver(object):
             logging.info("Warning: problem %s" % self.prob.status)
         return { 'objp': self.prob.value, 'status': self.prob.status }
 
+    def set_params(self, values):
+        "Set the values of the problem's cvx.Parameter objects by name"
+        params = { p.name(): p for p in self.prob.parameters() }
+        for name, val in values.items():
+            params[name].value = val
+
     def init_vars(self, x, y):
         self.x[:x.size] = x[:self.x.size]
         self.y[:y.size] = y[:self.y.size]
@@ -50,10 +79,197 @@ class CvxSolver(object):
             v.value = x[i:i+v.size].reshape(v.shape)
             i += v.size
 
+    def copy(self):
+        """ Solver for the same (compiled) problem with a fresh state
+
+        The values of the problem's variables are cleared, so that no
+        warm start from a previous solve applies.
+        """
+        solver = copy.copy(self)
+        solver.x = np.zeros_like(self.x)
+        solver.y = np.zeros_like(self.y)
+        for v in self.variables:
+            v.value = None
+        return solver
+
     @property
     def state(self):
         return (self.x, self.y)
 
+def _engine_params(engine, params, cvx_params):
+    "Parameters for engine `engine` (pdhg or a CVXPY backend)"
+    if engine == "pdhg":
+        return dict(params)
+    return dict(cvx_params, cvx_solver=engine, verbose=False)
+
+def _portfolio_run(model, engine, params, conn):
+    try:
+        t0 = time.time()
+        model.setup_solver("pdhg" if engine == "pdhg" else "cvx")
+        details = model.solve(dict(params))
+        details['time'] = time.time() - t0
+        conn.send((details, model.state))
+    except BaseException as e:
+        logging.exception("Portfolio engine %s failed." % engine)
+        conn.send((None, repr(e)))
+    finally:
+        conn.close()
+
+class PortfolioSolver(object):
+    """ Race several solver engines on the same model
+
+    Each engine ("pdhg" or the name of a CVXPY backend such as "SCS",
+    "ECOS" or "CLARABEL") solves the model in a forked process. The first
+    engine that reaches the requested accuracy wins and all other engines
+    are cancelled. If no engine reaches it, the result of the engine that
+    finished first is used. The state is in the model's (post-processed)
+    output format.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.state = None
+
+    def accuracy_params(self, engine, term_relgap):
+        if engine == "pdhg":
+            return { 'term_relgap': term_relgap }
+        return { k: term_relgap for k in CVX_ACCURACY_PARAMS.get(engine, []) }
+
+    def reached(self, engine, details, term_relgap):
+        if engine != "pdhg":
+            return details.get('status', None) == "optimal"
+        if details.get('status', None) == "converged":
+            return True
+        if 'objp' in details and 'objd' in details:
+            gap = details['objp'] - details['objd']
+            return gap/max(abs(details['objp']), np.finfo(float).eps) \
+                   <= term_relgap
+        return False
+
+    def solve(self, engines=["pdhg", "MOSEK"], continue_at=None,
+                    term_relgap=1e-5, cvx_params={}, cbfun=None, **params):
+        """ Race the engines against each other.
+
+        Args:
+            engines : list of engine names
+            continue_at : initial state in the model's output format
+            term_relgap : requested accuracy (relative duality gap)
+            cvx_params : additional options for all CVXPY backends
+            cbfun : ignored, callbacks can't be called across processes
+            params : additional parameters of the PDHG engine
+        Returns:
+            details of the winning engine with key 'portfolio' describing
+            the outcome of the race
+        """
+        if cbfun is not None:
+            logging.warning("Solver callbacks are not supported by the "
+                            "solver portfolio.")
+        ctx = multiprocessing.get_context("fork")
+        procs, t0 = {}, time.time()
+        for engine in engines:
+            eparams = _engine_params(engine, params, cvx_params)
+            eparams.update(self.accuracy_params(engine, term_relgap))
+            eparams['continue_at'] = continue_at
+            conn_recv, conn_send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_portfolio_run,
+                               args=(self.model, engine, eparams, conn_send))
+            proc.start()
+            conn_send.close()
+            procs[conn_recv] = (engine, proc)
+        logging.info("Racing solver engines: %s" % ", ".join(engines))
+
+        race = { engine: { 'status': "cancelled" } for engine in engines }
+        winner, fallback = None, None
+        while winner is None and len(procs) > 0:
+            for conn in multiprocessing.connection.wait(list(procs.keys())):
+                engine, proc = procs.pop(conn)
+                try:
+                    details, state = conn.recv()
+                except EOFError:
+                    details, state = None, "process died"
+                conn.close()
+                proc.join()
+                elapsed = time.time() - t0
+                if details is None:
+                    race[engine] = { 'status': "failed", 'error': state,
+                                     'time': elapsed }
+                    continue
+                race[engine] = { 'status': details.get('status', None),
+                                 'time': elapsed }
+                if self.reached(engine, details, term_relgap):
+                    winner = (engine, details, state)
+                    break
+                elif fallback is None:
+                    fallback = (engine, details, state)
+        for conn, (engine, proc) in procs.items():
+            proc.terminate()
+            proc.join()
+            conn.close()
+            race[engine]['time'] = time.time() - t0
+
+        if winner is None:
+            winner = fallback
+        if winner is None:
+            raise RuntimeError("All solver engines failed.")
+        engine, details, self.state = winner
+        logging.info("Solver engine %s won after %.2fs."
+                     % (engine, race[engine]['time']))
+        details['portfolio'] = { 'winner': engine, 'engines': race }
+        return details
+
+class StagedSolver(object):
+    """ Run several solver engines one after another on the same model
+
+    Each stage is warm-started from the result of the previous one. The
+    state is handed over in the model's output format, i.e. it is mapped
+    through `post` of the previous engine and `pre` of the next one. A
+    typical pipeline is a cheap low-accuracy PDHG solve followed by an
+    interior point solve (or the reverse for polishing).
+    """
+    def __init__(self, model):
+        self.model = model
+        self.state = None
+
+    def solve(self, stages=[("pdhg", { 'term_relgap': 1e-3 }), "MOSEK"],
+                    continue_at=None, cvx_params={}, cbfun=None, **params):
+        """ Run the stages.
+
+        Args:
+            stages : list of engine names (pdhg or a CVXPY backend) or
+                     pairs (engine name, dict of stage specific parameters)
+            continue_at : initial state in the model's output format
+            cvx_params : additional options for all CVXPY backends
+            cbfun : callback for PDHG stages, info['stage'] is the stage
+            params : additional parameters of the PDHG engine
+        Returns:
+            details of the last stage with key 'stages' holding the engine,
+            time, objective and status of each stage
+        """
+        state, records = continue_at, []
+        for i, stage in enumerate(stages):
+            engine, sparams = (stage, {}) if isinstance(stage, str) else stage
+            eparams = _engine_params(engine, params, cvx_params)
+            eparams.update(sparams)
+            eparams['continue_at'] = state
+            if engine == "pdhg" and cbfun is not None:
+                eparams['cbfun'] = lambda st, info, i=i: \
+                                   cbfun(st, dict(info, stage=i))
+            logging.info("Stage %d: %s" % (i, engine))
+            t0 = time.time()
+            self.model.setup_solver("pdhg" if engine == "pdhg" else "cvx")
+            details = self.model.solve(eparams)
+            state = self.model.state
+            records.append({ 'engine': engine, 'time': time.time() - t0,
+                             'objp': details.get('objp', None),
+                             'status': details.get('status', None) })
+            logging.info("Stage %d (%s) took %.2fs, objective: %s"
+                         % (i, engine, records[-1]['time'],
+                            records[-1]['objp']))
+        # post() of the last engine applies to the state from now on
+        self.model.solver = self
+        self.state = state
+        details['stages'] = records
+        return details
+
 class PDBaseModel(object):
     "Base class for models that are formulated as saddle-point problems"
     name = ""
@@ -73,17 +289,94 @@ class PDBaseModel(object):
 
     def setup_solver_cvx(self): pass
     def setup_solver_pdhg(self): pass
-    def setup_solver(self, solver_name):
+
+    def cvx_cache_key(self):
+        """ Hashable description of the structure of the CVX formulation
+
+        Models whose CVX formulation only depends on the data through
+        cvx.Parameter objects (see `cvx_param_values`) can return a key
+        here (e.g. made of the data's array shapes) to have the problem
+        canonicalized only once per process. The default (None) disables
+        caching.
+        """
+        return None
+
+    def cvx_param_values(self):
+        "Values of the cvx.Parameter objects (by name) for the current data"
+        return {}
+
+    def setup_solver(self, solver_name, stats=None):
+        """ Set up the solver engine (pdhg|cvx|portfolio|staged).
+
+        If `stats` (a repyducible.instrument.OpStats) is given, calls to
+        the PDHG operators and proximal mappings are recorded in it.
+        """
         self.solver_name = solver_name
-        if solver_name == "cvx":
+        if solver_name == "portfolio":
+            self.solver = PortfolioSolver(self)
+        elif solver_name == "staged":
+            self.solver = StagedSolver(self)
+        elif solver_name == "cvx":
             logging.info("Solving using CVX...")
+            key = self.cvx_cache_key()
+            if key is not None:
+                key = (type(self).__module__, type(self).__name__, key)
             self.setup_solver_cvx()
-            self.solver = CvxSolver(self.cvx_obj, self.cvx_vars, self.cvx_constr)
+            self.solver = _cvx_cache.get(key, None)
+            if self.solver is None:
+                self.solver = CvxSolver(self.cvx_obj, self.cvx_vars,
+                                        self.cvx_constr)
+                if key is not None:
+                    _cvx_cache[key] = self.solver
+                    while len(_cvx_cache) > CVX_CACHE_SIZE:
+                        _cvx_cache.popitem(last=False)
+            else:
+                # the expressions set up above only differ in the values of
+                # their parameters, solve the compiled problem instead
+                logging.info("Reusing compiled CVX problem.")
+                _cvx_cache.move_to_end(key)
+                self.solver = self.solver.copy()
+                self.cvx_obj = self.solver.objective
+                self.cvx_vars = self.solver.variables
+                self.cvx_constr = self.solver.constraints
+            self.solver.set_params(self.cvx_param_values())
         else:
             self.setup_solver_pdhg()
             logging.info("Solving using Opymize (PDHG)...")
             from opymize.solvers import PDHG
-            self.solver = PDHG(self.pdhg_G, self.pdhg_F, self.pdhg_linop)
+            G, F, linop = self.pdhg_G, self.pdhg_F, self.pdhg_linop
+            if stats is not None:
+                from repyducible.instrument import InstrumentedOp, \
+                                                   InstrumentedFunctional
+                G = InstrumentedFunctional(G, "G", stats)
+                F = InstrumentedFunctional(F, "F", stats)
+                linop = InstrumentedOp(linop, "linop", stats)
+            self.solver = PDHG(G, F, linop)
+
+    def prolong(self, state, coarse):
+        """ Map the state of the model `coarse` to this model's resolution
+
+        Used for multiresolution solves (see Data.restrict). The states are
+        in the models' output format (see `post`).
+        """
+        raise NotImplementedError("%s does not support prolongation."
+                                  % type(self).__name__)
+
+    def stitch(self, states, regions, overlap):
+        """ Combine the states of models solved on tiles of this model's data
+
+        Used for tiled solves (see Data.split and repyducible.tiling.blend).
+        The states are in the models' output format (see `post`).
+
+        Args:
+            states : list of tile states
+            regions : list of regions (tuples of slices) of the tiles
+            overlap : number of grid points shared by neighbouring tiles
+        Returns:
+            state of this model
+        """
+        raise NotImplementedError("%s does not support tiling."
+                                  % type(self).__name__)
 
     def pre_cvx(self, data): return data
     def pre_pdhg(self, data): return data
@@ -103,6 +396,11 @@ class PDBaseModel(object):
 
     def solve(self, solver_params):
         continue_at = solver_params.get('continue_at', self.state)
+        if self.solver_name in ["portfolio", "staged"]:
+            solver_params['continue_at'] = continue_at
+            details = self.solver.solve(**solver_params)
+            self.state = self.solver.state
+            return details
         solver_params['continue_at'] = self.pre(continue_at)
         details = self.solver.solve(**solver_params)
         self.state = self.post(self.solver.state)
@@ -118,3 +416,149 @@ class PDBaseModel(object):
                    G.prox(0.5 + np.random.rand()),
                    F.conj.prox(0.5 + np.random.rand())]:
             test_gpu_op(op)
+
+class BatchedModel(PDBaseModel):
+    """ Several PDBaseModel instances solved as one saddle-point problem
+
+    The PDHG formulations of the models are combined block-diagonally
+    (opymize's SplitSum and DiagBlockOp), so that a single PDHG loop solves
+    all instances, with the usual solver parameters and callbacks. The state
+    is the list of the models' states.
+
+    Whenever the solver calls back, the duality gap of each instance is
+    evaluated. An instance whose relative gap drops below `term_relgap` is
+    considered converged, and its state at that iteration is kept as its
+    result, while the loop continues until the combined problem terminates.
+    """
+    name = "batched"
+
+    def __init__(self, models):
+        PDBaseModel.__init__(self, None)
+        self.models = models
+        self.instances = None
+
+    def setup_solver(self, solver_name, stats=None):
+        if solver_name != "pdhg":
+            raise ValueError("Batched models can only be solved using PDHG.")
+        PDBaseModel.setup_solver(self, solver_name, stats=stats)
+
+    def setup_solver_pdhg(self):
+        from opymize.functionals import SplitSum
+        from opymize.linear import DiagBlockOp
+        for m in self.models:
+            m.solver_name = "pdhg"
+            m.setup_solver_pdhg()
+        self.pdhg_G = SplitSum([m.pdhg_G for m in self.models])
+        self.pdhg_F = SplitSum([m.pdhg_F for m in self.models])
+        self.pdhg_linop = DiagBlockOp([m.pdhg_linop for m in self.models])
+
+    def pre_pdhg(self, states):
+        if states is None or all(s is None for s in states):
+            return None
+        xs, ys = [], []
+        for m,s in zip(self.models, states):
+            if s is None:
+                x = np.zeros(m.pdhg_linop.x.size)
+                y = np.zeros(m.pdhg_linop.y.size)
+            else:
+                x, y = m.pre(s)
+            xs.append(x.ravel())
+            ys.append(y.ravel())
+        return (np.concatenate(xs), np.concatenate(ys))
+
+    def split(self, state):
+        "Split a state of the combined problem into the models' states"
+        x, y = state
+        ix = np.cumsum([m.pdhg_linop.x.size for m in self.models])[:-1]
+        iy = np.cumsum([m.pdhg_linop.y.size for m in self.models])[:-1]
+        return list(zip(np.split(x, ix), np.split(y, iy)))
+
+    def post_pdhg(self, state):
+        return [m.post(s) for m,s in zip(self.models, self.split(state))]
+
+    def objectives(self, state):
+        """ Primal and dual objective of each instance
+
+        Args:
+            state : state of the combined problem (as used by the solver)
+        Returns:
+            list of (objp, objd) tuples, one per model
+        """
+        result = []
+        for m,(x,y) in zip(self.models, self.split(state)):
+            linop = m.pdhg_linop
+            Kx, Kty = np.zeros(linop.y.size), np.zeros(linop.x.size)
+            linop(x, Kx)
+            linop.adjoint(y, Kty)
+            objp = m.pdhg_G(x)[0] + m.pdhg_F(Kx)[0]
+            objd = -m.pdhg_G.conj(-Kty)[0] - m.pdhg_F.conj(y)[0]
+            result.append((objp, objd))
+        return result
+
+    def track(self, state, info, term_relgap):
+        "Update the per-instance details, freezing converged instances"
+        objectives = self.objectives(state)
+        for inst, (x,y), (objp, objd) in zip(self.instances, self.split(state),
+                                             objectives):
+            if inst['status'] == "converged":
+                continue
+            inst.update(objp=objp, objd=objd, gap=objp - objd,
+                        iter=info.get('iter', None))
+            if (objp - objd)/max(abs(objp), np.finfo(float).eps) \
+               <= term_relgap:
+                inst['status'] = "converged"
+                inst['state'] = (x.copy(), y.copy())
+
+    def solve(self, solver_params):
+        """ Solve all instances and set the models' states
+
+        Returns:
+            details of the combined problem with the details of each instance
+            (objp, objd, gap, iter and status) in 'instances'
+        """
+        solver_params = dict(solver_params)
+        term_relgap = solver_params.get('term_relgap', 1e-5)
+        cbfun = solver_params.get('cbfun', None)
+        def track(state, info):
+            self.track(state, info, term_relgap)
+            if cbfun is not None:
+                cbfun(state, info)
+        solver_params['cbfun'] = track
+        self.instances = [{ 'status': None } for m in self.models]
+        details = PDBaseModel.solve(self, solver_params)
+        final = self.split(self.solver.state)
+        for inst, (objp, objd), s in zip(self.instances,
+                                         self.objectives(self.solver.state),
+                                         final):
+            if inst['status'] != "converged":
+                inst.update(objp=objp, objd=objd, gap=objp - objd,
+                            iter=details.get('iter', None),
+                            status=details.get('status', None))
+                inst['state'] = s
+        for m,inst in zip(self.models, self.instances):
+            m.state = m.post(inst.pop('state'))
+        self.state = [m.state for m in self.models]
+        details['instances'] = self.instances
+        return details
+
+def solve_batched(models, solver_params):
+    """ Solve several instances of a PDBaseModel in one PDHG loop
+
+    The models (e.g. one Model applied to many Data instances) are combined
+    in a BatchedModel. Afterwards, each model's `state` is set as if it had
+    been solved on its own.
+
+    Args:
+        models : list of PDBaseModel instances
+        solver_params : parameters of opymize's PDHG.solve, 'continue_at' is
+                        a list of states (one per model) if given
+    Returns:
+        details of the combined problem, with the details of each instance
+        in 'instances' (see BatchedModel.solve)
+    """
+    logging.info("Solving %d instances using batched PDHG..." % len(models))
+    model = BatchedModel(models)
+    model.setup_solver("pdhg")
+    solver_params = dict(solver_params)
+    solver_params.setdefault('continue_at', [m.state for m in models])
+    return model.solve(solver_params)
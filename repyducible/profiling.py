@@ -0,0 +1,96 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import resource
+import tracemalloc
+
+def current_rss():
+    "Resident set size of this process in bytes (None if unknown)"
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except:
+        return None
+
+def peak_rss():
+    "Peak resident set size of this process in bytes"
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else 1024*rss
+
+class PhaseProfiler(object):
+    """ Wall-clock time and memory usage of consecutive phases of a run
+
+    Phases are started with `start(name)` which ends the previous phase.
+    For each phase, the wall time, the RSS at its end and the process' peak
+    RSS so far are recorded. If `trace_memory` is set, tracemalloc is used
+    to additionally record the peak of memory allocated during the phase
+    (this slows down allocation-heavy Python code).
+    """
+    def __init__(self, trace_memory=False):
+        self.phases = []
+        self.current = None
+        self.trace_memory = False
+        if trace_memory:
+            self.enable_tracing()
+
+    def enable_tracing(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.trace_memory = True
+
+    def start(self, name):
+        self.stop()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.current = {
+            'name': name, 'start': time.time(),
+            '_t0': time.perf_counter(), '_rss0': current_rss(),
+        }
+
+    def stop(self):
+        if self.current is None:
+            return
+        phase = self.current
+        phase['time'] = time.perf_counter() - phase.pop('_t0')
+        rss0 = phase.pop('_rss0')
+        phase['rss'] = current_rss()
+        phase['rss_delta'] = None if None in [rss0, phase['rss']] \
+                                  else phase['rss'] - rss0
+        phase['peak_rss'] = peak_rss()
+        if self.trace_memory:
+            phase['traced_peak'] = tracemalloc.get_traced_memory()[1]
+        self.phases.append(phase)
+        self.current = None
+
+    def summary(self):
+        "One-line summary of the phases' wall times"
+        total = sum(p['time'] for p in self.phases)
+        return "Profile: " + ", ".join("%s %.2fs" % (p['name'], p['time'])
+                                       for p in self.phases) \
+             + " (total %.2fs, peak RSS %.1f MB)" % (total, peak_rss()/1e6)
+
+    def write(self, path):
+        self.stop()
+        with open(path, 'w') as f:
+            json.dump({ 'phases': self.phases, 'peak_rss': peak_rss() },
+                      f, indent=1)
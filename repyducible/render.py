@@ -0,0 +1,131 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import logging
+import importlib
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+
+from repyducible.util import args_from_logs
+from repyducible.demo import discover_modules
+
+_experiment = None
+
+def _plot_snapshot(i):
+    _experiment.plot_snapshot(i, _experiment.snapshots[i])
+
+def plot_snapshots(exp, processes=1):
+    """ Render one frame per snapshot using `exp.plot_snapshot`.
+
+    Unless the plot mode is "show", frames are rendered on a pool of
+    forked worker processes that share the experiment with the parent.
+
+    Args:
+        exp : Experiment instance with loaded snapshots
+        processes : number of worker processes (1 renders inline)
+    """
+    global _experiment
+    n = len(exp.snapshots)
+    if processes <= 1 or n <= 1 or exp.pargs.plot == "show":
+        for i in range(n):
+            exp.plot_snapshot(i, exp.snapshots[i])
+        return
+    logging.info("Rendering %d frames on %d processes..." % (n, processes))
+    _experiment = exp
+    pool = multiprocessing.get_context("fork").Pool(processes)
+    try:
+        pool.map(_plot_snapshot, range(n), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _experiment = None
+
+def spawn_render(exp):
+    """ Render the results of `exp` in a detached process.
+
+    The process runs `python -m repyducible.render` on the output directory
+    and survives the exit of the calling process. The progress is recorded
+    in the field 'render' of the run manifest.
+    """
+    pkg_name = exp.DataClass.__module__.rpartition(".")[0].rpartition(".")[0]
+    cmd = [sys.executable, "-m", "repyducible.render", pkg_name,
+           exp.output_dir, "--processes", str(exp.pargs.render_processes)]
+    exp.update_manifest(render="pending")
+    logging.info("Rendering in background: %s" % " ".join(cmd))
+    subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+def render_output(Experiment, DataClass, ModelClass, output_dir, args=[]):
+    """ Run postprocessing and plotting for an existing result.
+
+    Args:
+        Experiment : subclass of repyducible.experiment.Experiment
+        DataClass, ModelClass : as expected by `Experiment`
+        output_dir : output directory of a finished run
+        args : command line arguments of the run
+    Returns:
+        the Experiment instance
+    """
+    args = [a for a in args if a != "--resume"] + ["--output", output_dir]
+    exp = Experiment(DataClass, ModelClass, args, backup=False)
+    if not os.path.exists(exp.output_file('result')[0]):
+        raise ValueError("No result found in %s." % output_dir)
+    exp.update_manifest(render="running")
+    try:
+        exp.solve()
+        exp.render()
+    except BaseException:
+        exp.update_manifest(render="failed")
+        raise
+    exp.update_manifest(render="done")
+    logging.info(exp.profiler.summary())
+    return exp
+
+def pkg_render(pkg_name, args):
+    pkg = importlib.import_module("%s" % pkg_name)
+    data_modules, model_modules = discover_modules(pkg_name)
+
+    parser = ArgumentParser(prog='render', description="See README.md.")
+    parser.add_argument('outputs', metavar='OUTPUT_DIR', nargs='+', type=str,
+                        help="Output directories of finished runs.")
+    parser.add_argument('--processes', metavar='PROCESSES', default=None,
+                        type=int, help="Number of processes rendering "
+                                       "snapshot frames.")
+    parser.add_argument('--plot', metavar='PLOT_MODE', default=None,
+                        type=str, help="Override the plot mode (show|hide|no).")
+    pargs = parser.parse_args(args)
+
+    for output_dir in pargs.outputs:
+        dataset, model, eargs = args_from_logs(output_dir)
+        if None in [dataset, model]:
+            logging.error("No run found in %s." % output_dir)
+            continue
+        if pargs.processes is not None:
+            eargs += ["--render-processes", str(pargs.processes)]
+        if pargs.plot is not None:
+            eargs += ["--plot", pargs.plot]
+        model_module = importlib.import_module(model_modules[model])
+        data_module = importlib.import_module(data_modules[dataset])
+        render_output(pkg.Experiment, data_module.Data, model_module.Model,
+                      output_dir, eargs)
+
+if __name__ == "__main__":
+    pkg_render(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,418 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import io
+import queue
+import logging
+import threading
+import collections.abc
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+from repyducible.storage import ArrayPickler, ArrayUnpickler
+
+# iteration, record offset, record length, offset of pickled metadata
+INDEX_FIELDS = 4
+ALIGN = 64
+
+class SnapshotStore(collections.abc.Sequence):
+    """ Append-only container of solver snapshots
+
+    All snapshots of a run are kept in a single data file `<path>.bin` where
+    each record consists of the raw (aligned) array chunks followed by the
+    pickled remainder of the snapshot. The index file `<path>.idx` holds
+    one fixed-size row per record, so that any snapshot can be located in
+    constant time. Reading a snapshot memory-maps its arrays.
+
+    The store behaves like a (lazy) list of snapshot dicts.
+
+    Retention is applied whenever a snapshot is appended: if `last` is
+    positive, only the last `last` snapshots are kept. If `budget` is
+    positive, older snapshots are kept more sparsely than recent ones: a
+    snapshot that is `age` iterations older than the most recent one is
+    only kept if its iteration is a multiple of 2**floor(log2(1 + age/w)).
+    Snapshots within the window `w` are all kept, the next 2w iterations
+    at every other iteration, the next 4w at every fourth and so on.
+    Whenever the total size of all stored snapshots exceeds `budget` bytes,
+    the window is halved. The space of removed snapshots is reclaimed as
+    soon as it exceeds the space of the remaining ones.
+    """
+    def __init__(self, path, last=0, budget=0):
+        self.data_file = "%s.bin" % path
+        self.index_file = "%s.idx" % path
+        self.last = last
+        self.budget = budget
+        self.window = None
+        self.f = None
+        self._index = None
+        self._rows = 0
+        self._positions = None
+
+    def open(self):
+        """ Open the store for appending. """
+        self.f = open(self.data_file, 'ab')
+        self.f.seek(0, io.SEEK_END)
+        index = self.index
+        valid = index[:,1] + index[:,2] <= self.f.tell()
+        if not np.all(valid):
+            index = index[:np.argmin(valid)]
+            self._index, self._rows = index, index.shape[0]
+        if index.shape[0] > 0:
+            # drop records not referenced by the index (interrupted writes)
+            end = index[-1,1] + index[-1,2]
+            if self.f.tell() > end:
+                self.f.truncate(end)
+                self.f.seek(end)
+        elif self.f.tell() > 0:
+            self.f.truncate(0)
+            self.f.seek(0)
+        self.fi = open(self.index_file, 'ab')
+        self.fi.truncate(index.size*index.itemsize)
+        self.fi.seek(0, io.SEEK_END)
+        return self
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.fi.close()
+            self.f = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def index(self):
+        if self._index is None:
+            if os.path.exists(self.index_file):
+                index = np.fromfile(self.index_file, dtype=np.int64)
+                n = index.size // INDEX_FIELDS
+                self._index = index[:n*INDEX_FIELDS].reshape(n, INDEX_FIELDS)
+            else:
+                self._index = np.zeros((0, INDEX_FIELDS), dtype=np.int64)
+            self._rows = self._index.shape[0]
+        # rows beyond `_rows` are spare capacity for appending
+        return self._index[:self._rows]
+
+    def append(self, it, snapshot):
+        """ Append a snapshot for iteration `it`.
+
+        Args:
+            it : iteration number
+            snapshot : picklable object (usually a dict with keys 'data' and
+                       'details')
+        """
+        self.f.write(b"\0"*((-self.f.tell()) % ALIGN))
+        start = self.f.tell()
+        def store_array(arr):
+            pad = (-self.f.tell()) % ALIGN
+            self.f.write(b"\0"*pad)
+            offset = self.f.tell() - start
+            self.f.write(np.ascontiguousarray(arr).data)
+            return (arr.dtype.str, arr.shape, offset)
+
+        meta = io.BytesIO()
+        ArrayPickler(meta, store_array, min_size=1 << 12).dump(snapshot)
+        meta_offset = self.f.tell() - start
+        self.f.write(meta.getvalue())
+        self.f.flush()
+        length = self.f.tell() - start
+
+        row = np.array([it, start, length, meta_offset], dtype=np.int64)
+        self.fi.write(row.tobytes())
+        self.fi.flush()
+        n = self.index.shape[0]
+        if n == self._index.shape[0]:
+            index = np.zeros((max(16, 2*n), INDEX_FIELDS), dtype=np.int64)
+            index[:n] = self._index
+            self._index = index
+        self._index[n] = row
+        self._rows = n + 1
+        if self._positions is not None:
+            self._positions[it] = n
+        self.retain()
+
+    def retain(self):
+        """ Apply the retention policy (`last` and `budget`). """
+        remove = []
+        n = len(self)
+        if self.last > 0 and n > self.last:
+            remove = list(range(n - self.last))
+        if self.budget > 0:
+            keep = np.ones(n, dtype=bool)
+            keep[remove] = False
+            it = self.iterations
+            while True:
+                if self.window is not None:
+                    age = (it[-1] - it)/self.window
+                    keep &= (it % 2.0**np.floor(np.log2(1 + age)) == 0)
+                if self.index[keep,2].sum() <= self.budget \
+                   or keep.sum() <= 2 or it[-1] == it[0]:
+                    break
+                if self.window is None:
+                    self.window = (it[-1] - it[0])/2.0
+                else:
+                    self.window /= 2.0
+            remove = np.nonzero(~keep)[0]
+        if len(remove) > 0:
+            self.remove(remove)
+
+    def remove(self, positions):
+        """ Remove the snapshots at the given positions from the store. """
+        keep = np.ones(len(self), dtype=bool)
+        keep[positions] = False
+        index = self.index[keep]
+        if os.path.getsize(self.data_file) > 2*index[:,2].sum():
+            self._compact(index)
+        else:
+            self._write_index(index)
+
+    def truncate(self, it):
+        """ Remove all snapshots taken at or after iteration `it`. """
+        positions = np.nonzero(self.iterations >= it)[0]
+        if positions.size > 0:
+            self.remove(positions)
+
+    def _write_index(self, index):
+        tmp_file = "%s.tmp-%d" % (self.index_file, os.getpid())
+        index.astype(np.int64).tofile(tmp_file)
+        os.replace(tmp_file, self.index_file)
+        self._index, self._rows = index, index.shape[0]
+        self._positions = None
+        if self.f is not None:
+            self.fi.close()
+            self.fi = open(self.index_file, 'ab')
+
+    def _compact(self, index):
+        index = index.copy()
+        tmp_file = "%s.tmp-%d" % (self.data_file, os.getpid())
+        with open(self.data_file, 'rb') as fin, open(tmp_file, 'wb') as fout:
+            for row in index:
+                fout.write(b"\0"*((-fout.tell()) % ALIGN))
+                fin.seek(row[1])
+                row[1] = fout.tell()
+                remaining = row[2]
+                while remaining > 0:
+                    chunk = fin.read(min(remaining, 1 << 24))
+                    fout.write(chunk)
+                    remaining -= len(chunk)
+        os.replace(tmp_file, self.data_file)
+        if self.f is not None:
+            self.f.close()
+            self.f = open(self.data_file, 'ab')
+        self._write_index(index)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        _, start, _, meta_offset = self.index[i]
+
+        def load_array(pid):
+            dtype, shape, offset = pid
+            return np.memmap(self.data_file, dtype=dtype, mode='c',
+                             offset=start + offset, shape=shape)
+
+        with open(self.data_file, 'rb') as f:
+            f.seek(start + meta_offset)
+            return ArrayUnpickler(f, load_array).load()
+
+    def rewrite(self, fn, processes=1):
+        """ Replace each snapshot `s` by `fn(s)`.
+
+        The snapshots are processed by `processes` threads (in order) and
+        written to a new store that then replaces this one.
+        """
+        iterations = self.iterations.copy()
+        tmp_path = "%s.tmp-%d" % (os.path.splitext(self.data_file)[0],
+                                  os.getpid())
+        tmp = SnapshotStore(tmp_path).open()
+        pool = ThreadPool(processes)
+        try:
+            for it, snapshot in zip(iterations, pool.imap(fn, self)):
+                tmp.append(it, snapshot)
+        finally:
+            pool.close()
+            pool.join()
+            tmp.close()
+        os.replace(tmp.data_file, self.data_file)
+        os.replace(tmp.index_file, self.index_file)
+        self._index = None
+        self._positions = None
+        if self.f is not None:
+            self.close()
+            self.open()
+
+    @property
+    def iterations(self):
+        return self.index[:,0]
+
+    def find(self, it):
+        """ Position of the (last) snapshot taken at iteration `it`.
+
+        Raises:
+            KeyError if there is no such snapshot
+        """
+        if self._positions is None:
+            self._positions = { int(it): i for i,it in enumerate(self.iterations) }
+        return self._positions[it]
+
+    def at_iter(self, it):
+        return self[self.find(it)]
+
+class PostSnapshots(collections.abc.Sequence):
+    """ View of a list of snapshots that applies `post` on first access
+
+    Used for snapshots stored with deferred post-processing. The results of
+    `post` are memoized for the `memo_size` most recently used snapshots.
+    """
+    def __init__(self, snapshots, post, memo_size=16):
+        self.snapshots = snapshots
+        self.post = post
+        self.memo_size = memo_size
+        self.memo = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        if i in self.memo:
+            self.memo.move_to_end(i)
+        else:
+            self.memo[i] = self.post(self.snapshots[i])
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return self.memo[i]
+
+    def __getattr__(self, name):
+        return getattr(self.snapshots, name)
+
+    def at_iter(self, it):
+        return self[self.snapshots.find(it)]
+
+class SnapshotWriter(object):
+    """ Solver callback that hands snapshots to a background thread
+
+    The state passed to the callback is copied into a pool of reusable
+    buffers and queued; `write(state, info)` is then called from the
+    writer thread. If the queue is full, `backpressure` decides what
+    happens:
+
+        "block" : wait for the writer thread (no snapshot is lost)
+        "drop" : discard the snapshot
+        "coarsen" : discard the snapshot and from now on only keep every
+                    other callback (the stride doubles every time)
+
+    Independently of the queue, only every `every`-th iteration is stored,
+    and if `log` is positive, at most `log` snapshots per decade of
+    iterations are stored (log-spaced). Floating point states are stored
+    with reduced precision if `dtype` (e.g. "float32") is given.
+
+    Call `close()` to wait for all queued snapshots to be written.
+    """
+    def __init__(self, write, queue_size=8, backpressure="block",
+                       every=1, log=0, dtype=None):
+        if backpressure not in ["block", "drop", "coarsen"]:
+            raise ValueError("Unknown backpressure policy: %s" % backpressure)
+        self.write = write
+        self.backpressure = backpressure
+        self.every = every
+        self.log = log
+        self.log_level = -1
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.buffers = queue.Queue()
+        self.ncalls = 0
+        self.stride = 1
+        self.dropped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, state, info):
+        self.ncalls += 1
+        if self.error is not None:
+            raise self.error
+        if (self.ncalls - 1) % self.stride != 0 or info['iter'] % self.every != 0:
+            return
+        if self.log > 0:
+            level = int(self.log*np.log10(info['iter'] + 1))
+            if level == self.log_level:
+                return
+            self.log_level = level
+        if self.backpressure != "block" and self.queue.full():
+            self.dropped += 1
+            if self.backpressure == "coarsen":
+                self.stride *= 2
+                logging.debug("Snapshot queue full, keeping every %d-th "
+                              "snapshot from now on." % self.stride)
+            return
+        self.queue.put((self._copy(state), dict(info)))
+
+    def _copy(self, state):
+        arrays = [state] if isinstance(state, np.ndarray) else list(state)
+        try:
+            buf = self.buffers.get_nowait()
+            if len(buf) != len(arrays) or any(b.shape != a.shape
+                    or b.dtype != self._dtype(a) for a,b in zip(arrays, buf)):
+                buf = None
+        except queue.Empty:
+            buf = None
+        if buf is None:
+            buf = [np.empty_like(a, dtype=self._dtype(a)) for a in arrays]
+        for a,b in zip(arrays, buf):
+            np.copyto(b, a, casting='unsafe')
+        return buf[0] if isinstance(state, np.ndarray) else tuple(buf)
+
+    def _dtype(self, a):
+        if self.dtype is not None and a.dtype.kind == "f":
+            return self.dtype
+        return a.dtype
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            state, info = item
+            try:
+                if self.error is None:
+                    self.write(state, info)
+            except Exception as e:
+                logging.exception("Writing snapshot failed.")
+                self.error = e
+            self.buffers.put([state] if isinstance(state, np.ndarray)
+                                     else list(state))
+
+    def close(self):
+        """ Wait until all queued snapshots are written. """
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped > 0:
+            logging.info("Dropped %d of %d snapshots (queue full)."
+                         % (self.dropped, self.ncalls))
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,86 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+
+from repyducible.cache import params_hash
+
+Stage = collections.namedtuple("Stage", ["name", "inputs", "deps", "key"])
+
+class StageGraph(object):
+    """ Stages of a run with declared inputs and dependencies
+
+    The key of a stage is a hash of its name, its inputs (parameters,
+    source hashes) and the keys of the stages it depends on. Changing an
+    input thus changes the key of the affected stage and of all stages
+    downstream of it, while the keys of upstream stages stay the same.
+    Outputs of a stage are stored (and cached) under its key.
+
+    `previous` holds the keys recorded by an earlier run in the same output
+    directory (None if nothing was recorded). Outputs of that run can be
+    reused for stages whose key is unchanged.
+    """
+    def __init__(self, previous=None):
+        self.stages = collections.OrderedDict()
+        self.previous = previous
+        self.recorded = dict(previous or {})
+
+    def add(self, name, inputs={}, deps=[]):
+        """ Add (or replace) a stage.
+
+        Args:
+            name : name of the stage
+            inputs : dict of (hashable, see `params_hash`) inputs
+            deps : names of previously added stages this stage depends on
+        Returns:
+            the key of the stage
+        """
+        missing = [d for d in deps if d not in self.stages]
+        if len(missing) > 0:
+            raise ValueError("Stage %s depends on unknown stages: %s"
+                             % (name, ", ".join(missing)))
+        key = params_hash(name, inputs, [self.stages[d].key for d in deps])
+        self.stages[name] = Stage(name, inputs, list(deps), key)
+        return key
+
+    def key(self, name):
+        return self.stages[name].key
+
+    def valid(self, name):
+        """ Whether outputs of stage `name` from the previous run are valid
+
+        Output directories without recorded keys (written by earlier
+        versions) are trusted.
+        """
+        if self.previous is None:
+            return True
+        return self.previous.get(name, None) == self.key(name)
+
+    def invalidated(self):
+        "Names of the stages whose key changed since the previous run"
+        return [name for name in self.stages if not self.valid(name)]
+
+    def record(self, *names):
+        """ Mark the given stages as run with their current keys.
+
+        Returns:
+            dict of recorded keys (by stage name) to be stored with the run
+        """
+        for name in names:
+            self.recorded[name] = self.key(name)
+        return self.recorded
@@ -0,0 +1,110 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import pickle
+import numpy as np
+
+INDEX_FILE = "index.pickle"
+
+class ArrayPickler(pickle.Pickler):
+    """ Pickler that hands large numpy arrays to `store_array`
+
+    Arrays are replaced by whatever `store_array` returns, e.g. the name of
+    a file the array was written to. Arrays referenced more than once are
+    stored only once.
+    """
+    def __init__(self, file, store_array, min_size=1 << 16):
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.store_array = store_array
+        self.min_size = min_size
+        self.stored = {}
+
+    def persistent_id(self, obj):
+        if type(obj) not in [np.ndarray, np.memmap] or obj.dtype.hasobject \
+           or obj.nbytes < self.min_size:
+            return None
+        if id(obj) not in self.stored:
+            self.stored[id(obj)] = (obj, self.store_array(obj))
+        return self.stored[id(obj)][1]
+
+class ArrayUnpickler(pickle.Unpickler):
+    "Counterpart of `ArrayPickler`: `load_array` restores arrays"
+    def __init__(self, file, load_array):
+        pickle.Unpickler.__init__(self, file)
+        self.load_array = load_array
+
+    def persistent_load(self, pid):
+        return self.load_array(pid)
+
+def _fsync(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+def save(data, path, min_size=1 << 16, sync=False):
+    """ Store `data` in directory `path`, large arrays as separate .npy files
+
+    The directory is written under a temporary name and then moved into
+    place, so that arrays memory-mapped from an older version stay valid.
+
+    Args:
+        data : any picklable object
+        path : path to output directory
+        min_size : arrays with fewer bytes are pickled along with the rest
+        sync : if True, all files are flushed to disk before renaming
+    """
+    tmp_path = "%s.tmp-%d" % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    names = []
+    def store_array(arr):
+        name = "array-%04d.npy" % len(names)
+        names.append(name)
+        np.save(os.path.join(tmp_path, name), arr)
+        return name
+
+    with open(os.path.join(tmp_path, INDEX_FILE), 'wb') as f:
+        ArrayPickler(f, store_array, min_size=min_size).dump(data)
+    if sync:
+        for name in names + [INDEX_FILE]:
+            _fsync(os.path.join(tmp_path, name))
+
+    old_path = "%s.old-%d" % (path, os.getpid())
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+def load(path, mmap_mode='c'):
+    """ Restore data stored with `save`, memory-mapping large arrays lazily
+
+    Args:
+        path : path to directory written by `save`
+        mmap_mode : passed to `numpy.load`, default is copy-on-write
+    Returns:
+        the restored data
+    """
+    def load_array(name):
+        return np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+
+    with open(os.path.join(path, INDEX_FILE), 'rb') as f:
+        return ArrayUnpickler(f, load_array).load()
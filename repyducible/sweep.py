@@ -0,0 +1,349 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import csv
+import json
+import time
+import logging
+import itertools
+import importlib
+import multiprocessing
+import numpy as np
+from argparse import ArgumentParser
+
+from repyducible.data import ARRAYS_DIR
+from repyducible.model import solve_batched
+from repyducible.checkpoint import write_checkpoint, DEFAULT_MAXITER
+from repyducible.util import data_from_file, link_file, params_to_str, \
+                             DictAction
+from repyducible.demo import discover_modules
+from repyducible.experiment import Experiment as BaseExperiment
+
+def grid_points(model_grid={}, solver_grid={}):
+    """ Expand parameter grids to the list of all combinations.
+
+    Args:
+        model_grid : dict mapping model parameter names to lists of values
+        solver_grid : dict mapping solver parameter names to lists of values
+    Returns:
+        list of points, i.e. dicts with keys 'model' and 'solver'
+    """
+    keys = [('model', k) for k in sorted(model_grid.keys())] \
+         + [('solver', k) for k in sorted(solver_grid.keys())]
+    values = [model_grid[k] for k in sorted(model_grid.keys())] \
+           + [solver_grid[k] for k in sorted(solver_grid.keys())]
+    points = []
+    for combo in itertools.product(*values):
+        point = { 'model': {}, 'solver': {} }
+        for (group, k), v in zip(keys, combo):
+            point[group][k] = v
+        points.append(point)
+    return points
+
+def point_args(args, point, output_dir):
+    """ Command line for running a single point of a sweep.
+
+    Plotting is disabled unless `args` explicitly asks for it.
+    """
+    args = ["--plot", "no"] + list(args) + ["--output", output_dir]
+    if len(point.get('model', {})) > 0:
+        args += ["--model-params", params_to_str(point['model'])]
+    if len(point.get('solver', {})) > 0:
+        args += ["--solver-params", params_to_str(point['solver'])]
+    return args
+
+_worker_data = None
+
+def _init_worker(data_file):
+    global _worker_data
+    format = os.path.splitext(data_file)[1][1:]
+    _worker_data = data_from_file(data_file, format=format)
+    _worker_data.storage_dir = os.path.join(os.path.dirname(data_file),
+                                            ARRAYS_DIR)
+
+def _run_point(task):
+    Experiment, DataClass, ModelClass, args, i, point, output_dir = task
+    row = {
+        'point': i, 'output': output_dir,
+        'model': params_to_str(point.get('model', {})),
+        'solver': params_to_str(point.get('solver', {})),
+        'objective': None, 'score': None, 'status': None, 'runtime': None,
+    }
+    t0 = time.time()
+    try:
+        exp = Experiment(DataClass, ModelClass, point_args(args, point, output_dir),
+                         data=_worker_data, backup=False)
+        logging.info("Applying model '%s' to dataset '%s'." \
+            % (ModelClass.__module__.rpartition(".")[2],
+               DataClass.__module__.rpartition(".")[2]))
+        exp.run()
+        details = exp.result['details']
+        row['objective'] = details.get('objp', None)
+        row['score'] = exp.score()
+        row['status'] = details.get('status', None)
+    except (Exception, SystemExit) as e:
+        logging.exception("Sweep point %d failed." % i)
+        row['status'] = "error: %s" % e
+    row['runtime'] = time.time() - t0
+    return row
+
+def _prepare_points(Experiment, DataClass, ModelClass, args, n):
+    "Root experiment and `n` point directories linked to its data"
+    root = Experiment(DataClass, ModelClass, args)
+    source_files = [f for f in os.listdir(root.output_dir)
+                    if "-source." in f or f == ARRAYS_DIR]
+    output_dirs = []
+    for i in range(n):
+        output_dir = os.path.join(root.output_dir, "point-%03d" % i)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        for f in [os.path.basename(root.data_file)] + source_files:
+            link_file(os.path.join(root.output_dir, f),
+                      os.path.join(output_dir, f))
+        output_dirs.append(output_dir)
+    return root, output_dirs
+
+def _solve_batched(root, ModelClass, points, output_dirs):
+    """ Solve the models of all points in a single PDHG loop
+
+    The state of each point is written as a checkpoint to its output
+    directory, so that running the point afterwards only finishes it (see
+    `Experiment.solve`). All points must share the solver parameters.
+    """
+    if root.pargs.solver != "pdhg":
+        raise ValueError("Batched sweeps require the pdhg solver.")
+    solver_params = dict(root.params['solver'], **root.pargs.solver_params)
+    if any(len(p.get('solver', {})) > 0 for p in points):
+        raise ValueError("Batched sweep points can't vary solver parameters.")
+    model_params = dict(root.params['model'], **root.pargs.model_params)
+    models = [ModelClass(root.data, **dict(model_params, **p.get('model', {})))
+              for p in points]
+    details = solve_batched(models, solver_params)
+    maxiter = solver_params.get('term_maxiter', DEFAULT_MAXITER)
+    for m, inst, output_dir in zip(models, details['instances'], output_dirs):
+        inst = dict(inst)
+        if inst['iter'] is None:
+            inst['iter'] = maxiter
+        write_checkpoint(output_dir, m.state, inst, format=root.pargs.storage)
+
+def _run_points(root, tasks, processes):
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(root.data_file,))
+    try:
+        return list(pool.imap(_run_point, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+def sweep(Experiment, DataClass, ModelClass, args, points, processes=None,
+          batch=False):
+    """ Run the `Experiment` pipeline for each point on a process pool.
+
+    The data is generated (or restored) once in the sweep's output directory
+    and loaded once per worker process. Each point gets its own subdirectory
+    `point-<i>` that links to the shared data file and source backup.
+
+    With `batch`, the models of all points are solved together in one PDHG
+    loop first (see repyducible.model.BatchedModel), and the pool only
+    finishes the points.
+
+    Args:
+        Experiment : subclass of repyducible.experiment.Experiment
+        DataClass, ModelClass : as expected by `Experiment`
+        args : command line arguments shared by all points
+        points : list of dicts with (optional) keys 'model' and 'solver'
+        processes : number of worker processes (default: number of CPUs)
+        batch : whether to solve the points in one batched PDHG loop
+    Returns:
+        list of summary rows (dicts), one per point
+    """
+    root, output_dirs = _prepare_points(Experiment, DataClass, ModelClass,
+                                        args, len(points))
+    if batch:
+        logging.info("Solving %d points batched..." % len(points))
+        _solve_batched(root, ModelClass, points, output_dirs)
+    tasks = [(Experiment, DataClass, ModelClass, args, i, point, output_dir)
+             for i, (point, output_dir) in enumerate(zip(points, output_dirs))]
+    logging.info("Sweeping over %d points..." % len(points))
+    rows = _run_points(root, tasks, processes)
+
+    summary_file = os.path.join(root.output_dir, "sweep.csv")
+    fields = ['point', 'model', 'solver', 'objective', 'score', 'status',
+              'runtime', 'output']
+    with open(summary_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    logging.info("Sweep summary (written to %s):" % summary_file)
+    for r in rows:
+        logging.info("% 4d  %-30s %-20s objective=%s status=%s %.2fs"
+            % (r['point'], r['model'], r['solver'], r['objective'],
+               r['status'], r['runtime']))
+    return rows
+
+def search(Experiment, DataClass, ModelClass, args, points, budget=100,
+           eta=2, rounds=None, processes=None):
+    """ Successive halving over the given points.
+
+    In the first round, all points are solved with `budget` iterations
+    (solver parameter term_maxiter). After each round, the points are ranked
+    by `Experiment.score()` (lower is better) and only the best `1/eta` of
+    them survive. The survivors are resumed with `eta` times the previous
+    total number of iterations. The history of all rounds is written to
+    `search.json` in the search's output directory.
+
+    The `Experiment` must define `score()`, there is no default ranking.
+
+    Args:
+        Experiment, DataClass, ModelClass, args, points, processes :
+            as for `sweep`
+        budget : number of iterations in the first round
+        eta : factor by which the number of points is reduced (and the
+              number of iterations is increased) per round
+        rounds : maximum number of rounds (default: until one point is left)
+    Returns:
+        the history, a list of dicts (one per round)
+    """
+    if Experiment.score is BaseExperiment.score:
+        raise TypeError("%s must define score() for searching."
+                        % Experiment.__name__)
+    root, output_dirs = _prepare_points(Experiment, DataClass, ModelClass,
+                                        args, len(points))
+    history_file = os.path.join(root.output_dir, "search.json")
+    history = []
+    survivors = list(range(len(points)))
+    ranked, total = [], 0
+    while len(survivors) > 0:
+        r = len(history)
+        iterations = budget*eta**r - total
+        total += iterations
+        rargs = list(args) + ["--solver-params", "term_maxiter=%d" % iterations]
+        if r > 0:
+            rargs.append("--resume")
+        tasks = [(Experiment, DataClass, ModelClass, rargs, i, points[i],
+                  output_dirs[i]) for i in survivors]
+        logging.info("Search round %d: %d points, %d iterations..."
+                     % (r, len(tasks), total))
+        rows = _run_points(root, tasks, processes)
+
+        ranked = sorted([row for row in rows if row['score'] is not None],
+                        key=lambda row: row['score'])
+        keep = int(np.ceil(len(survivors)/eta))
+        if len(ranked) <= 1 or (rounds is not None and r + 1 >= rounds):
+            keep = 0
+        survivors = [row['point'] for row in ranked[:keep]]
+        history.append({ 'round': r, 'iterations': total, 'rows': rows,
+                         'survivors': survivors })
+        with open(history_file, 'w') as f:
+            json.dump(history, f, indent=1, default=repr)
+        for row in ranked:
+            logging.info("% 4d  %-30s %-20s score=%s objective=%s%s"
+                % (row['point'], row['model'], row['solver'], row['score'],
+                   row['objective'], " *" if row['point'] in survivors else ""))
+
+    best = ranked[0] if len(ranked) > 0 else None
+    if best is not None:
+        logging.info("Best point: %d (%s %s, score=%s), see %s."
+                     % (best['point'], best['model'], best['solver'],
+                        best['score'], best['output']))
+    logging.info("Search history written to %s." % history_file)
+    return history
+
+def pkg_search(pkg_name, args):
+    pkg = importlib.import_module("%s" % pkg_name)
+    data_modules, model_modules = discover_modules(pkg_name)
+
+    parser = ArgumentParser(prog='search', description="See README.md.")
+    parser.add_argument('dataset', metavar='DATASET',
+                        choices=data_modules.keys(),
+                        help='One of the available datasets: %s.' \
+                              % ", ".join(data_modules.keys()))
+    parser.add_argument('model', metavar='MODEL',
+                        choices=model_modules.keys(),
+                        help='One of the available models: %s.' \
+                              % ", ".join(model_modules.keys()))
+    parser.add_argument('--model-grid', metavar='GRID',
+                        default={}, type=str, action=DictAction,
+                        help="Lists of model parameter values to search, "
+                             "e.g. \"lbd=[0.1,1.0]\".")
+    parser.add_argument('--solver-grid', metavar='GRID',
+                        default={}, type=str, action=DictAction,
+                        help="Lists of solver parameter values to search.")
+    parser.add_argument('--points', metavar='POINTS', default="[]", type=str,
+                        help="List of points of the form "
+                             "dict(model=dict(...), solver=dict(...)).")
+    parser.add_argument('--budget', metavar='ITERATIONS', default=100,
+                        type=int, help="Iterations in the first round.")
+    parser.add_argument('--eta', metavar='ETA', default=2, type=int,
+                        help="Keep the best 1/ETA of the points per round.")
+    parser.add_argument('--rounds', metavar='ROUNDS', default=None, type=int,
+                        help="Maximum number of rounds.")
+    parser.add_argument('--processes', metavar='N', default=None, type=int,
+                        help="Number of worker processes.")
+    pargs, params = parser.parse_known_args(args)
+
+    points = eval(pargs.points)
+    if len(pargs.model_grid) + len(pargs.solver_grid) > 0:
+        points += grid_points(pargs.model_grid, pargs.solver_grid)
+
+    model_module = importlib.import_module(model_modules[pargs.model])
+    data_module = importlib.import_module(data_modules[pargs.dataset])
+    return search(pkg.Experiment, data_module.Data, model_module.Model,
+                  params, points, budget=pargs.budget, eta=pargs.eta,
+                  rounds=pargs.rounds, processes=pargs.processes)
+
+def pkg_sweep(pkg_name, args):
+    pkg = importlib.import_module("%s" % pkg_name)
+    data_modules, model_modules = discover_modules(pkg_name)
+
+    parser = ArgumentParser(prog='sweep', description="See README.md.")
+    parser.add_argument('dataset', metavar='DATASET',
+                        choices=data_modules.keys(),
+                        help='One of the available datasets: %s.' \
+                              % ", ".join(data_modules.keys()))
+    parser.add_argument('model', metavar='MODEL',
+                        choices=model_modules.keys(),
+                        help='One of the available models: %s.' \
+                              % ", ".join(model_modules.keys()))
+    parser.add_argument('--model-grid', metavar='GRID',
+                        default={}, type=str, action=DictAction,
+                        help="Lists of model parameter values to sweep over, "
+                             "e.g. \"lbd=[0.1,1.0]\".")
+    parser.add_argument('--solver-grid', metavar='GRID',
+                        default={}, type=str, action=DictAction,
+                        help="Lists of solver parameter values to sweep over.")
+    parser.add_argument('--points', metavar='POINTS', default="[]", type=str,
+                        help="List of points of the form "
+                             "dict(model=dict(...), solver=dict(...)).")
+    parser.add_argument('--processes', metavar='N', default=None, type=int,
+                        help="Number of worker processes.")
+    parser.add_argument('--batch', action="store_true", default=False,
+                        help="Solve all points in a single PDHG loop "
+                             "(points may only vary model parameters).")
+    pargs, params = parser.parse_known_args(args)
+
+    points = eval(pargs.points)
+    if len(pargs.model_grid) + len(pargs.solver_grid) > 0:
+        points += grid_points(pargs.model_grid, pargs.solver_grid)
+
+    model_module = importlib.import_module(model_modules[pargs.model])
+    data_module = importlib.import_module(data_modules[pargs.dataset])
+    return sweep(pkg.Experiment, data_module.Data, model_module.Model,
+                 params, points, processes=pargs.processes, batch=pargs.batch)
@@ -0,0 +1,119 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import itertools
+import multiprocessing
+import numpy as np
+
+def tile_regions(shape, tiles, overlap):
+    """ Regular grid of overlapping tiles
+
+    Args:
+        shape : shape of the (spatial) domain
+        tiles : number of tiles along each axis (axes beyond the length of
+                `tiles` are not split)
+        overlap : number of grid points shared by neighbouring tiles
+    Returns:
+        list of regions (tuples of slices), one per tile
+    """
+    axes = []
+    for n, k in zip(shape, tiles):
+        bounds = np.linspace(0, n, k + 1).round().astype(int)
+        h = overlap // 2
+        axes.append([slice(max(0, int(bounds[i]) - h),
+                           min(n, int(bounds[i + 1]) + overlap - h))
+                     for i in range(k)])
+    return list(itertools.product(*axes))
+
+def blend_weights(region, shape, overlap):
+    """ Weights of a tile that fade out linearly towards neighbouring tiles
+
+    For the tiles of `tile_regions`, the weights of all tiles add up to one.
+    """
+    w = np.ones(())
+    for sl, n in zip(region, shape):
+        start, stop, _ = sl.indices(n)
+        wi = np.ones(stop - start)
+        ramp = (np.arange(min(overlap, stop - start)) + 0.5)/overlap
+        if start > 0:
+            wi[:ramp.size] = np.minimum(wi[:ramp.size], ramp)
+        if stop < n:
+            wi[wi.size - ramp.size:] = np.minimum(wi[wi.size - ramp.size:],
+                                                  ramp[::-1])
+        w = w[...,None]*wi
+    return w
+
+def blend(shape, pieces, overlap):
+    """ Stitch overlapping tiles of an array with linear blending
+
+    Args:
+        shape : shape of the full array
+        pieces : list of pairs (region, array), where the region (tuple of
+                 slices) refers to the leading axes of the full array
+        overlap : number of grid points shared by neighbouring tiles
+    Returns:
+        the full array
+    """
+    out = np.zeros(shape)
+    wsum = np.zeros(shape)
+    for region, arr in pieces:
+        w = blend_weights(region, shape, overlap)
+        w = w.reshape(w.shape + (1,)*(len(shape) - len(region)))
+        out[region] += w*arr
+        wsum[region] += w
+    return out/np.fmax(wsum, np.finfo(float).eps)
+
+_tile_task = None
+
+def _solve_tile(i):
+    ModelClass, model_params, datas, solver_name, solver_params = _tile_task
+    t0 = time.time()
+    model = ModelClass(datas[i], **model_params)
+    model.setup_solver(solver_name)
+    details = model.solve(dict(solver_params))
+    details['time'] = time.time() - t0
+    return details, model.state
+
+def solve_on_tiles(ModelClass, model_params, datas, solver_name,
+                   solver_params, processes=None):
+    """ Solve the same model on several (tile) datasets in parallel
+
+    The datasets are shared with the (forked) worker processes, only the
+    states are sent back.
+
+    Args:
+        ModelClass : subclass of PDBaseModel
+        model_params : dict of model parameters
+        datas : list of Data instances
+        solver_name, solver_params : as for `PDBaseModel.setup_solver` and
+                                     `PDBaseModel.solve`
+        processes : number of worker processes (default: number of CPUs)
+    Returns:
+        list of pairs (details, state), one per dataset
+    """
+    global _tile_task
+    _tile_task = (ModelClass, model_params, datas, solver_name,
+                  { k: v for k,v in solver_params.items() if k != 'cbfun' })
+    pool = multiprocessing.get_context("fork").Pool(processes)
+    try:
+        return pool.map(_solve_tile, range(len(datas)), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _tile_task = None
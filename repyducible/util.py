@@ -24,13 +24,17 @@ import os
 import errno
 import glob
 import zipfile
+import shutil
 import pickle
 import inspect
 import re
 import importlib
 import argparse
+import json
 from datetime import datetime
 
+from repyducible import storage
+
 import logging
 class MyFormatter(logging.Formatter):
     def format(self, record):
@@ -92,23 +96,84 @@ def output_dir_create(output_dir):
             print("Can't create directory {}!".format(output_dir))
             raise
 
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def link_file(src, dst):
+    """ Hard link `src` to `dst`, falling back to a copy across filesystems.
+
+    Args:
+        src : path to existing file or directory (linked recursively)
+        dst : path to new file (replaced if it exists)
+    """
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.remove(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=_link_or_copy)
+    else:
+        _link_or_copy(src, dst)
+
 def data_from_file(path, format="np"):
     """ Load numpy or pickle data from the given file.
 
     Args:
         path : path to data file
-        format : if "pickle", pickle is used to load the data (else numpy is used)
+        format : if "pickle", pickle is used to load the data, if "mmap", the
+                 data is restored from a directory written by
+                 `repyducible.storage.save` (else numpy is used)
     Returns:
         restored numpy or pickle data
     """
     try:
         if format == "pickle":
             return pickle.load(open(path, 'rb'))
+        elif format == "mmap":
+            return storage.load(path)
         else:
             return np.load(open(path, 'rb'))
     except:
         return None
 
+def data_to_file(data, path, format="np", sync=False):
+    """ Store numpy or pickle data in the given file.
+
+    The file is written to a temporary location first and then renamed, so
+    that readers never see partial files and hard links to a previous
+    version of the file are left untouched.
+
+    Args:
+        data : data to store
+        path : path to data file
+        format : if "pickle", pickle is used to store the data, if "mmap",
+                 `repyducible.storage.save` is used (else numpy is used)
+        sync : if True, the data is flushed to disk before renaming
+    """
+    if format == "mmap":
+        storage.save(data, path, sync=sync)
+        return
+    tmp_path = "%s.tmp-%d" % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        if format == "pickle":
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            np.save(f, data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def remove_file(path):
+    "Remove a file or directory written by `data_to_file`, if it exists"
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
 def zip_add_dir(zipf, path, exclude=[]):
     """ Add directory given by `path` to opened zip file `zipf`
 
@@ -131,7 +196,50 @@ def zip_add_dir(zipf, path, exclude=[]):
             zipped_path = file_path.replace(base_path, "", 1).lstrip("\\/")
             zipf.write(file_path, zipped_path)
 
+RUN_MANIFEST = "run.json"
+
+def read_run_manifest(output_dir):
+    """ Load the run manifest (see `update_run_manifest`) of an output dir.
+
+    Args:
+        output_dir : path to output directory
+    Returns:
+        manifest dict or None if there is no manifest
+    """
+    try:
+        with open(os.path.join(output_dir, RUN_MANIFEST), "r") as f:
+            return json.load(f)
+    except:
+        return None
+
+def update_run_manifest(output_dir, **fields):
+    """ Update the run manifest `run.json` in the given output directory.
+
+    The manifest is a JSON file with structured information about the run,
+    such as dataset, model, command line arguments and status. Values that
+    can't be represented in JSON are stored using their repr.
+
+    Args:
+        output_dir : path to output directory
+        fields : fields to set
+    Returns:
+        the updated manifest dict
+    """
+    manifest = read_run_manifest(output_dir)
+    manifest = {} if manifest is None else manifest
+    manifest.update(json.loads(json.dumps(fields, default=repr)))
+    path = os.path.join(output_dir, RUN_MANIFEST)
+    tmp_path = "%s.tmp-%d" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+    return manifest
+
 def args_from_logs(output_dir):
+    manifest = read_run_manifest(output_dir)
+    if manifest is not None and 'args' in manifest:
+        return manifest['dataset'], manifest['model'], list(manifest['args'])
+
     log_paths = glob.glob(os.path.join(output_dir, "*.log"))
     dataset = None
     model = None
@@ -149,28 +257,59 @@ def args_from_logs(output_dir):
                     model, dataset = m.group(2), m.group(3)
     return dataset, model, args
 
-def backup_source(obj, output_dir, extra=[]):
+def source_files(obj, extra=[]):
+    """ List the source files that make up the package `obj` belongs to.
+
+    Args:
+        obj : some object defined in the package
+        extra : list of glob patterns of additional files
+    Returns:
+        list of pairs (path to file, path inside of the backup)
+    """
     obj_pkg = re.sub(r"\..*$", "", inspect.getmodule(obj).__name__)
     pkg_path = importlib.import_module(obj_pkg).__path__[0]
+    base_path = pkg_path.rstrip("/").rpartition("/")[0] + "/"
+    files = []
+    for root, dirs, fnames in os.walk(pkg_path):
+        if os.path.basename(root) == "__pycache__":
+            continue
+        for fname in fnames:
+            file_path = os.path.join(root, fname)
+            zipped_path = file_path.replace(base_path, "", 1).lstrip("\\/")
+            files.append((file_path, zipped_path))
+    for f in sum([glob.glob(extraf) for extraf in extra],[]):
+        files.append((f, f))
+    return sorted(files, key=lambda f: f[1])
+
+def backup_source(obj, output_dir, extra=[]):
     zip_file = os.path.join(output_dir, "{}-source.zip".format(
         datetime.now().strftime('%Y%m%d%H%M%S')
     ))
     zipf = zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED)
-    zip_add_dir(zipf, pkg_path, exclude=["__pycache__"])
-    for f in sum([glob.glob(extraf) for extraf in extra],[]):
-        zipf.write(f)
+    for file_path, zipped_path in source_files(obj, extra=extra):
+        zipf.write(file_path, zipped_path)
     zipf.close()
 
+def params_to_str(params):
+    """ Format a dict as parameter string as understood by `DictAction`.
+
+    Args:
+        params : dict of parameters (values must have an `eval`-able repr)
+    Returns:
+        a string like "a=1,b='x'"
+    """
+    return ",".join("%s=%r" % (k, v) for k, v in sorted(params.items()))
+
 class DictAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string):
-        valdict = getattr(namespace, self.dest, {})
+        valdict = dict(getattr(namespace, self.dest, None) or {})
         valdict.update(eval("dict(%s)" % values))
         setattr(namespace, self.dest, valdict)
 
 def ValidatedDictAction(params):
     class VDictAction(argparse.Action):
         def __call__(self, parser, namespace, values, option_string):
-            valdict = getattr(namespace, self.dest, {})
+            valdict = dict(getattr(namespace, self.dest, None) or {})
             try:
                 test = eval("dict(%s)" % values)
             except (SyntaxError, NameError):
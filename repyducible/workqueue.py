@@ -0,0 +1,291 @@
+
+# This file is part of Repyducible
+#
+# Copyright 2018 Thomas Vogt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import socket
+import logging
+import binascii
+import importlib
+import multiprocessing
+from datetime import datetime
+from argparse import ArgumentParser
+
+from repyducible.util import output_dir_create, params_to_str, DictAction
+from repyducible.demo import discover_modules
+from repyducible.sweep import grid_points
+
+class WorkQueue(object):
+    """ Queue of experiments in a directory shared between nodes
+
+    Layout of the queue directory:
+
+        jobs/<id>.json : run specs (dataset, model and command line args)
+        locks/<id>.lock : claimed jobs, created exclusively by a worker and
+                          touched regularly as heartbeat
+        status/<id>.json : state (running|done|failed), worker and output
+        results/<id>/ : default output directory of a job
+
+    Jobs whose lock hasn't been touched for `timeout` seconds belong to a
+    dead worker and are claimed again.
+    """
+    takeover_delay = 1.0
+
+    def __init__(self, path, timeout=300):
+        self.path = path
+        self.timeout = timeout
+        for d in ["jobs", "locks", "status", "results"]:
+            output_dir_create(os.path.join(path, d))
+
+    def _file(self, kind, job_id, ext):
+        return os.path.join(self.path, kind, "%s.%s" % (job_id, ext))
+
+    def _write_json(self, path, data):
+        tmp_path = "%s.tmp-%s-%d" % (path, socket.gethostname(), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
+
+    def _read_json(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except:
+            return None
+
+    def submit(self, dataset, model, args=[]):
+        """ Add a job to the queue.
+
+        Returns:
+            the job's id
+        """
+        job_id = "%s-%s" % (datetime.now().strftime('%Y%m%d%H%M%S%f'),
+                            binascii.hexlify(os.urandom(4)).decode())
+        self._write_json(self._file("jobs", job_id, "json"), {
+            'id': job_id, 'dataset': dataset, 'model': model,
+            'args': list(args), 'submitted': datetime.now().isoformat(),
+        })
+        return job_id
+
+    def jobs(self):
+        return sorted(f[:-5] for f in os.listdir(os.path.join(self.path, "jobs"))
+                      if f.endswith(".json"))
+
+    def job(self, job_id):
+        return self._read_json(self._file("jobs", job_id, "json"))
+
+    def status(self, job_id):
+        status = self._read_json(self._file("status", job_id, "json"))
+        return { 'state': "pending" } if status is None else status
+
+    def set_status(self, job_id, **fields):
+        status = self.status(job_id)
+        status.update(fields, updated=datetime.now().isoformat())
+        self._write_json(self._file("status", job_id, "json"), status)
+
+    def _stale(self, lock):
+        try:
+            return time.time() - os.stat(lock).st_mtime > self.timeout
+        except OSError:
+            return False
+
+    def _takeover(self, lock, worker):
+        """ Replace a stale lock by a fresh one of `worker`.
+
+        The fresh lock is renamed over the stale one, so that the lock file
+        exists at all times. Workers that found the same stale lock may do
+        the same concurrently, the last one to rename wins. The winner is
+        determined after waiting `takeover_delay` seconds for the others.
+
+        Returns:
+            whether the lock belongs to `worker`
+        """
+        fresh = "%s.new-%s" % (lock, worker)
+        with open(fresh, 'w') as f:
+            f.write(worker)
+        os.replace(fresh, lock)
+        time.sleep(self.takeover_delay)
+        try:
+            with open(lock, 'r') as f:
+                return f.read() == worker
+        except OSError:
+            return False
+
+    def claim(self, worker):
+        """ Claim the next job that is neither finished nor claimed.
+
+        Args:
+            worker : name of the claiming worker
+        Returns:
+            job id or None if there is nothing to do
+        """
+        for job_id in self.jobs():
+            if self.status(job_id)['state'] in ["done", "failed"]:
+                continue
+            lock = self._file("locks", job_id, "lock")
+            if os.path.exists(lock):
+                if not self._stale(lock):
+                    continue
+                if not self._takeover(lock, worker):
+                    continue
+                logging.info("Reclaiming job %s from dead worker." % job_id)
+            else:
+                try:
+                    fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except OSError:
+                    continue
+                os.write(fd, worker.encode("utf-8"))
+                os.close(fd)
+            if self.status(job_id)['state'] in ["done", "failed"]:
+                # finished while we were looking at it
+                self.release(job_id)
+                continue
+            return job_id
+        return None
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self._file("locks", job_id, "lock"))
+        except OSError:
+            # released in the meantime
+            pass
+
+    def release(self, job_id):
+        try:
+            os.remove(self._file("locks", job_id, "lock"))
+        except OSError:
+            pass
+
+def _run_job(Experiment, DataClass, ModelClass, args):
+    exp = Experiment(DataClass, ModelClass, args)
+    logging.info("Applying model '%s' to dataset '%s'." \
+        % (ModelClass.__module__.rpartition(".")[2],
+           DataClass.__module__.rpartition(".")[2]))
+    exp.run()
+
+def work(queue, Experiment, data_modules, model_modules, once=False,
+         poll=10.0, heartbeat=30.0):
+    """ Claim and execute jobs until the queue is empty (or forever).
+
+    Each job runs in a child process, so that failing jobs don't affect the
+    worker. Plotting is disabled unless the job's args ask for it.
+
+    Args:
+        queue : a WorkQueue
+        Experiment : subclass of repyducible.experiment.Experiment
+        data_modules, model_modules : as returned by `discover_modules`
+        once : if True, return when there is no job left
+        poll : seconds to wait before looking for new jobs
+        heartbeat : seconds between heartbeats of a running job
+    """
+    worker = "%s:%d" % (socket.gethostname(), os.getpid())
+    while True:
+        job_id = queue.claim(worker)
+        if job_id is None:
+            if once:
+                return
+            time.sleep(poll)
+            continue
+
+        job = queue.job(job_id)
+        args = ["--plot", "no"] + job['args']
+        if "--output" not in args:
+            args += ["--output", os.path.join(queue.path, "results", job_id)]
+        output_dir = args[len(args) - args[::-1].index("--output")]
+        queue.set_status(job_id, state="running", worker=worker,
+                         output=output_dir, started=datetime.now().isoformat())
+        logging.info("Running job %s..." % job_id)
+
+        DataClass = importlib.import_module(data_modules[job['dataset']]).Data
+        ModelClass = importlib.import_module(model_modules[job['model']]).Model
+        proc = multiprocessing.Process(target=_run_job,
+                                       args=(Experiment, DataClass, ModelClass, args))
+        proc.start()
+        while proc.is_alive():
+            queue.heartbeat(job_id)
+            proc.join(heartbeat)
+
+        state = "done" if proc.exitcode == 0 else "failed"
+        queue.set_status(job_id, state=state, exitcode=proc.exitcode,
+                         finished=datetime.now().isoformat())
+        queue.release(job_id)
+        logging.info("Job %s %s." % (job_id, state))
+
+def pkg_queue(pkg_name, args):
+    pkg = importlib.import_module("%s" % pkg_name)
+    data_modules, model_modules = discover_modules(pkg_name)
+
+    parser = ArgumentParser(prog='queue', description="See README.md.")
+    parser.add_argument('queue', metavar='QUEUE_DIR', type=str,
+                        help="Path to the (shared) queue directory.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    p_submit = subparsers.add_parser('submit', help="Submit jobs.")
+    p_submit.add_argument('dataset', metavar='DATASET',
+                          choices=data_modules.keys(),
+                          help='One of the available datasets: %s.' \
+                                % ", ".join(data_modules.keys()))
+    p_submit.add_argument('model', metavar='MODEL',
+                          choices=model_modules.keys(),
+                          help='One of the available models: %s.' \
+                                % ", ".join(model_modules.keys()))
+    p_submit.add_argument('--model-grid', metavar='GRID',
+                          default={}, type=str, action=DictAction,
+                          help="Submit one job for each combination of "
+                               "model parameter values.")
+    p_submit.add_argument('--solver-grid', metavar='GRID',
+                          default={}, type=str, action=DictAction,
+                          help="Submit one job for each combination of "
+                               "solver parameter values.")
+
+    p_work = subparsers.add_parser('work', help="Execute jobs.")
+    p_work.add_argument('--once', action="store_true", default=False,
+                        help="Exit when there are no jobs left.")
+    p_work.add_argument('--poll', metavar='SECONDS', default=10.0, type=float,
+                        help="Seconds between looking for new jobs.")
+    p_work.add_argument('--timeout', metavar='SECONDS', default=300.0,
+                        type=float, help="Seconds without heartbeat after "
+                                         "which a job is reclaimed.")
+
+    subparsers.add_parser('status', help="Show the state of all jobs.")
+    pargs, params = parser.parse_known_args(args)
+
+    if pargs.command == "submit":
+        queue = WorkQueue(pargs.queue)
+        points = grid_points(pargs.model_grid, pargs.solver_grid)
+        for point in points:
+            job_args = list(params)
+            if len(point['model']) > 0:
+                job_args += ["--model-params", params_to_str(point['model'])]
+            if len(point['solver']) > 0:
+                job_args += ["--solver-params", params_to_str(point['solver'])]
+            job_id = queue.submit(pargs.dataset, pargs.model, job_args)
+            logging.info("Submitted job %s." % job_id)
+    elif pargs.command == "work":
+        queue = WorkQueue(pargs.queue, timeout=pargs.timeout)
+        work(queue, pkg.Experiment, data_modules, model_modules,
+             once=pargs.once, poll=pargs.poll,
+             heartbeat=min(30.0, pargs.timeout/5))
+    else:
+        queue = WorkQueue(pargs.queue)
+        for job_id in queue.jobs():
+            job, status = queue.job(job_id), queue.status(job_id)
+            logging.info("%s  %-8s %s/%s %s %s" % (job_id, status['state'],
+                job['dataset'], job['model'], " ".join(job['args']),
+                status.get('output', "")))